@@ -0,0 +1,186 @@
+"""Static asset pipeline.
+
+    python -m app.assets
+
+The build fingerprints every file under static/ by content hash, writes
+gzip (and brotli, when that package is installed) copies of text assets,
+renders WebP/AVIF variants of the background JPEGs when Pillow is available
+and records everything in static/dist/manifest.json. Templates link assets
+through static_url(), which emits the fingerprinted URL when the manifest
+knows the file and the plain one otherwise, so the app also runs unbuilt.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from markupsafe import Markup
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+
+COMPRESSIBLE = {".css", ".js", ".map", ".svg", ".eot", ".ttf", ".json", ".txt", ".html"}
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+BACKGROUNDS = ["img/about-bg.jpg", "img/contact-bg.jpg", "img/edit-bg.jpg"]
+BACKGROUND_WIDTHS = [800, 1600]
+IMAGE_FORMATS = [("avif", "image/avif", {"quality": 50}), ("webp", "image/webp", {"quality": 75})]
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, max-age=3600"
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def fingerprint(path: str, digest: str):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{digest}{ext}"
+
+
+def write_compressed(path: str, data: bytes):
+    encodings = []
+    variants = [("gzip", ".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.insert(0, ("br", ".br", brotli.compress(data, quality=11)))
+    for encoding, suffix, compressed in variants:
+        # not worth a Content-Encoding header for a few percent
+        if len(compressed) < len(data) * 0.9:
+            target = os.path.join(DIST_DIR, path + suffix)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as file:
+                file.write(compressed)
+            encodings.append(encoding)
+    return encodings
+
+
+def write_image_variants(path: str, digest: str):
+    variants = []
+    with Image.open(os.path.join(STATIC_DIR, path)) as image:
+        image = image.convert("RGB")
+        root, _ = os.path.splitext(path)
+        for width in BACKGROUND_WIDTHS:
+            width = min(width, image.width)
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            for extension, media_type, options in IMAGE_FORMATS:
+                name = f"{root}-{width}.{digest}.{extension}"
+                try:
+                    resized.save(os.path.join(DIST_DIR, name), format=extension.upper(), **options)
+                except (KeyError, OSError):
+                    # this Pillow build has no encoder for the format
+                    continue
+                variants.append({"path": "dist/" + name, "width": width, "type": media_type})
+    return variants
+
+
+def build():
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(os.path.join(DIST_DIR, "img"))
+    manifest = {"files": {}, "encodings": {}, "images": {}}
+
+    for directory, subdirectories, files in os.walk(STATIC_DIR):
+        if directory == STATIC_DIR:
+            subdirectories.remove("dist")
+        for name in sorted(files):
+            full_path = os.path.join(directory, name)
+            path = os.path.relpath(full_path, STATIC_DIR).replace(os.sep, "/")
+            with open(full_path, "rb") as file:
+                data = file.read()
+            digest = content_hash(data)
+            manifest["files"][path] = fingerprint(path, digest)
+            if os.path.splitext(name)[1] in COMPRESSIBLE:
+                encodings = write_compressed(path, data)
+                if encodings:
+                    manifest["encodings"][path] = encodings
+            if path in BACKGROUNDS and Image is not None:
+                manifest["images"][path] = write_image_variants(path, digest)
+
+    with open(MANIFEST_PATH, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    return manifest
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {"files": {}, "encodings": {}, "images": {}}
+
+
+manifest = load_manifest()
+originals = {hashed: path for path, hashed in manifest["files"].items()}
+
+
+def static_url(path: str):
+    return "/static/" + manifest["files"].get(path, path)
+
+
+def background_style(path: str):
+    # Plain url() first for browsers without image-set(), then the modern
+    # formats: the narrow variant for 1x screens and the wide one for 2x.
+    style = f"background-image: url('{static_url(path)}');"
+    variants = manifest["images"].get(path)
+    if not variants:
+        return Markup(style)
+
+    widths = sorted({variant["width"] for variant in variants})
+    candidates = []
+    for _, media_type, _ in IMAGE_FORMATS:
+        for density, width in zip(("1x", "2x"), (widths[0], widths[-1])):
+            for variant in variants:
+                if variant["type"] == media_type and variant["width"] == width:
+                    candidates.append(f"url('/static/{variant['path']}') type('{media_type}') {density}")
+    return Markup(style + f" background-image: image-set({', '.join(candidates)});")
+
+
+class AssetStaticFiles(StaticFiles):
+    """StaticFiles that resolves fingerprinted names, serves the precompressed
+    copy the client accepts and sets Cache-Control."""
+
+    async def get_response(self, path, scope):
+        path = path.replace(os.sep, "/")
+        original = originals.get(path)
+        # everything else under dist/ is named by content; the manifest isn't
+        immutable = original is not None or (path.startswith("dist/") and path != "dist/manifest.json")
+        original = original or path
+
+        response = None
+        accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        accepted = {token.split(";")[0].strip() for token in accept_encoding.split(",")}
+        for encoding, suffix in ENCODINGS:
+            if encoding in manifest["encodings"].get(original, []) and encoding in accepted:
+                media_type = mimetypes.guess_type(original)[0] or "application/octet-stream"
+                response = FileResponse(os.path.join(DIST_DIR, original + suffix),
+                                        media_type=media_type, headers={"Content-Encoding": encoding})
+                break
+        if response is None:
+            response = await super().get_response(original, scope)
+
+        if response.status_code < 400:
+            response.headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+            if original in manifest["encodings"]:
+                response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+if __name__ == "__main__":
+    built = build()
+    print(f"fingerprinted {len(built['files'])} files, "
+          f"{len(built['encodings'])} precompressed, "
+          f"{sum(len(variants) for variants in built['images'].values())} image variants")
@@ -0,0 +1,156 @@
+"""Identicon avatars generated locally instead of linking to gravatar.com.
+
+The picture is derived from the md5 of the e-mail address only, so the same
+address always gets the same avatar and the bytes can be cached forever.
+Rendered images are kept on disk (settings.avatar_cache_dir), trimmed to
+settings.avatar_cache_max_bytes by least recent use, and served from
+/avatar/{email_hash}.
+"""
+import hashlib
+import io
+import os
+import re
+import struct
+import threading
+import zlib
+
+from sqlalchemy import text
+
+from .config import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+GRID = 5
+DEFAULT_SIZE = 100
+MIN_SIZE, MAX_SIZE = 16, 512
+HASH_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+GRAVATAR_PATTERN = re.compile(r"^https?://(?:www\.)?gravatar\.com/avatar/([0-9a-f]{32})")
+
+
+def email_hash(email: str):
+    return hashlib.md5(email.strip().lower().encode("utf-8")).hexdigest()
+
+
+def avatar_url(email: str, size: int = DEFAULT_SIZE):
+    return f"/avatar/{email_hash(email)}?s={size}"
+
+
+def identicon_pixels(digest: str, size: int):
+    # GitHub style: a 5x5 grid mirrored around the middle column, one colour
+    # from the tail of the hash on a light background, with half a cell margin.
+    raw = bytes.fromhex(digest)
+    colour = bytes((raw[13] // 2 + 32, raw[14] // 2 + 32, raw[15] // 2 + 32))
+    background = b"\xf0\xf0\xf0"
+    cells = [[False] * GRID for _ in range(GRID)]
+    for index in range(GRID * (GRID + 1) // 2):
+        column, row = divmod(index, GRID)
+        filled = raw[index % len(raw)] % 2 == 0
+        cells[row][column] = cells[row][GRID - 1 - column] = filled
+
+    cell = size / (GRID + 1)
+    margin = cell / 2
+    columns = [int((x - margin) // cell) if x >= margin else -1 for x in range(size)]
+    distinct_rows = {}
+    rows = []
+    for y in range(size):
+        grid_y = int((y - margin) // cell) if y >= margin else -1
+        if grid_y not in distinct_rows:
+            filled = cells[grid_y] if 0 <= grid_y < GRID else [False] * GRID
+            distinct_rows[grid_y] = b"".join(
+                colour if 0 <= grid_x < GRID and filled[grid_x] else background for grid_x in columns)
+        rows.append(distinct_rows[grid_y])
+    return rows
+
+
+def encode_png(rows, size: int):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    data = zlib.compress(b"".join(b"\x00" + row for row in rows), 9)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", data) + chunk(b"IEND", b"")
+
+
+def render(digest: str, size: int, image_format: str):
+    png = encode_png(identicon_pixels(digest, size), size)
+    if image_format == "png":
+        return png
+    output = io.BytesIO()
+    Image.open(io.BytesIO(png)).save(output, format="WEBP", lossless=True)
+    return output.getvalue()
+
+
+class DiskCache:
+    """Files under one directory, evicted oldest-used first above max_bytes."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return data
+
+    def set(self, name: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+        with self._lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory))
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+
+
+disk_cache = DiskCache(settings.avatar_cache_dir, settings.avatar_cache_max_bytes)
+
+
+def get_avatar(digest: str, size: int = DEFAULT_SIZE, image_format: str = "png"):
+    if image_format == "webp" and Image is None:
+        image_format = "png"
+    size = max(MIN_SIZE, min(size, MAX_SIZE))
+    name = f"{digest}-{size}.{image_format}"
+    data = disk_cache.get(name)
+    if data is None:
+        data = render(digest, size, image_format)
+        disk_cache.set(name, data)
+    return data, image_format
+
+
+def migrate_gravatar_urls(conn):
+    # Migration step: point users registered before local avatars at /avatar/
+    rows = conn.execute(text(
+        "SELECT id, avatar_url FROM users WHERE avatar_url LIKE '%gravatar.com/avatar/%'")).all()
+    for user_id, url in rows:
+        match = GRAVATAR_PATTERN.match(url)
+        if match:
+            conn.execute(text("UPDATE users SET avatar_url = :url WHERE id = :id"),
+                         {"url": f"/avatar/{match.group(1)}?s={DEFAULT_SIZE}", "id": user_id})
@@ -0,0 +1,275 @@
+"""Bulk export and import of users, posts and comments as NDJSON.
+
+One JSON object per line, tagged with its "type", users first, then posts,
+then comments, so a file can be imported in a single pass. Password hashes
+are never exported; imported users have no password until they reset it.
+
+Export reads each table through a streaming cursor (yield_per), so memory
+stays flat however big the database is. Import inserts batches of rows with
+executemany, commits once per batch and reports rows/s. Re-running an
+import is harmless, also after one that failed halfway: users that exist
+(same name or email), posts whose title exists and comments already on
+their post (same author, date and text) are skipped, and the comments of
+the skipped users and posts are attached to the rows that were there.
+
+    python -m app.bulk export > blog.ndjson
+    python -m app.bulk import blog.ndjson --batch 2000
+
+The same is available over HTTP as GET /export.ndjson and POST /import,
+both behind settings.bulk_api_token.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import sys
+import time
+
+from sqlalchemy import insert, or_, select
+from sqlalchemy.orm import Session
+
+from . import crud, models, rendering
+from .cache import invalidate_feeds, invalidate_index_pages
+
+BATCH_SIZE = 1000
+
+USER_FIELDS = ("id", "name", "email", "avatar_url")
+POST_FIELDS = ("id", "title", "subtitle", "date", "updated_at", "body", "author", "img_url", "owner_id")
+COMMENT_FIELDS = ("id", "text", "date", "owner_id", "post_id")
+
+EXPORTS = (
+    ("user", models.Users, USER_FIELDS),
+    ("post", models.BlogPost, POST_FIELDS),
+    ("comment", models.Comment, COMMENT_FIELDS),
+)
+
+
+# =======================EXPORT=========================
+
+def export_records(db: Session, batch: int = BATCH_SIZE):
+    for kind, model, fields in EXPORTS:
+        stmt = select(*(getattr(model, field) for field in fields)).order_by(model.id)
+        for row in db.execute(stmt.execution_options(yield_per=batch)).mappings():
+            yield {"type": kind, **row}
+
+
+def export_lines(db: Session, batch: int = BATCH_SIZE):
+    for record in export_records(db, batch):
+        yield json.dumps(record, default=encode) + "\n"
+
+
+def encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+# =======================IMPORT=========================
+
+class BulkImportError(ValueError):
+    pass
+
+
+class Importer:
+    """Feeds batches of parsed records into the database.
+
+    Ids in the file are the exporting database's; they are mapped to the
+    ids the rows get here, so an export can be loaded into a database that
+    already has content.
+    """
+
+    def __init__(self):
+        self.user_ids = {}
+        self.post_ids = {}
+        self.imported = {"user": 0, "post": 0, "comment": 0}
+        self.skipped = {"user": 0, "post": 0, "comment": 0}
+        self.started = time.perf_counter()
+
+    def feed(self, db: Session, records: list[dict]):
+        for kind, group in itertools.groupby(records, key=lambda record: record.get("type")):
+            handler = getattr(self, f"_{kind}s", None) if kind in self.imported else None
+            if handler is None:
+                raise BulkImportError(f"unknown record type {kind!r}")
+            try:
+                handler(db, list(group))
+            except (KeyError, TypeError, ValueError) as error:
+                db.rollback()
+                raise BulkImportError(f"bad {kind} record: {error!r}") from None
+        db.commit()
+
+    def finish(self, db: Session):
+        # whatever feed() didn't commit is dropped
+        db.rollback()
+        if self.imported["comment"]:
+            crud.reconcile_post_counters(db)
+        else:
+            invalidate_index_pages()
+        if self.imported["post"]:
+            invalidate_feeds()
+        return self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rows = sum(self.imported.values())
+        return {"imported": self.imported, "skipped": self.skipped,
+                "seconds": round(elapsed, 3), "rows_per_second": round(rows / elapsed, 1) if elapsed else None}
+
+    def _users(self, db, records):
+        users = models.Users
+        names = {record["name"] for record in records}
+        emails = {record.get("email") for record in records} - {None}
+        existing = db.execute(select(users.id, users.name, users.email).where(
+            or_(users.name.in_(names), users.email.in_(emails)))).all()
+        taken_names = {row.name for row in existing}
+        taken_emails = {row.email for row in existing}
+        ids_by_name = {row.name: row.id for row in existing}
+        ids_by_email = {row.email: row.id for row in existing if row.email is not None}
+
+        rows = []
+        for record in records:
+            if record["name"] in taken_names or record.get("email") in taken_emails:
+                self.skipped["user"] += 1
+                continue
+            taken_names.add(record["name"])
+            taken_emails.add(record.get("email"))
+            rows.append({"name": record["name"], "email": record.get("email"),
+                         "avatar_url": record.get("avatar_url"), "password": None})
+        if rows:
+            db.execute(insert(users), rows)
+            ids_by_name.update(db.execute(select(users.name, users.id).where(
+                users.name.in_([row["name"] for row in rows]))).all())
+            self.imported["user"] += len(rows)
+
+        for record in records:
+            # a user skipped for their email may be here under another name
+            user_id = ids_by_name.get(record["name"]) or ids_by_email.get(record.get("email"))
+            if user_id is not None:
+                self.user_ids[record["id"]] = user_id
+
+    def _posts(self, db, records):
+        posts = models.BlogPost
+        titles = {record["title"] for record in records}
+        taken = dict(db.execute(select(posts.title, posts.id).where(posts.title.in_(titles))).all())
+
+        rows, old_ids = [], {}
+        for record in records:
+            if record["title"] in taken:
+                # its comments may not have made it in yet
+                if taken[record["title"]] is not None:
+                    self.post_ids[record["id"]] = taken[record["title"]]
+                self.skipped["post"] += 1
+                continue
+            taken[record["title"]] = None
+            old_ids[record["title"]] = record["id"]
+            rows.append({**{field: record[field] for field in POST_FIELDS if field not in ("id", "updated_at")},
+                         "updated_at": parse_date(record.get("updated_at")) or datetime.datetime.utcnow(),
+                         "owner_id": self.user_ids.get(record.get("owner_id")),
+                         **rendering.render_post(record["body"])._asdict()})
+        if rows:
+            db.execute(insert(posts), rows)
+            for title, post_id in db.execute(select(posts.title, posts.id).where(posts.title.in_(old_ids))):
+                self.post_ids[old_ids[title]] = post_id
+            self.imported["post"] += len(rows)
+
+    def _comments(self, db, records):
+        comments = models.Comment
+        candidates = []
+        for record in records:
+            post_id = self.post_ids.get(record["post_id"])
+            owner_id = self.user_ids.get(record["owner_id"])
+            if post_id is None or owner_id is None:
+                self.skipped["comment"] += 1
+                continue
+            candidates.append({"text": record["text"], "date": datetime.datetime.fromisoformat(record["date"]),
+                               "owner_id": owner_id, "post_id": post_id})
+
+        def identity(row):
+            return row["post_id"], row["owner_id"], row["date"], row["text"]
+
+        existing = set()
+        if candidates:
+            existing = {identity(row) for row in db.execute(
+                select(comments.post_id, comments.owner_id, comments.date, comments.text).where(
+                    comments.post_id.in_({row["post_id"] for row in candidates}),
+                    comments.date.in_({row["date"] for row in candidates}))).mappings()}
+        rows = []
+        for row in candidates:
+            if identity(row) in existing:
+                self.skipped["comment"] += 1
+                continue
+            existing.add(identity(row))
+            rows.append(row)
+        if rows:
+            db.execute(insert(models.Comment), rows)
+            self.imported["comment"] += len(rows)
+
+
+def parse_date(value):
+    return datetime.datetime.fromisoformat(value) if value is not None else None
+
+
+def parse_line(line, number):
+    try:
+        record = json.loads(line)
+    except ValueError as error:
+        raise BulkImportError(f"line {number}: {error}") from None
+    if not isinstance(record, dict):
+        raise BulkImportError(f"line {number}: expected an object")
+    return record
+
+
+def read_batches(lines, batch: int = BATCH_SIZE):
+    records = []
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            records.append(parse_line(line, number))
+            if len(records) >= batch:
+                yield records
+                records = []
+    if records:
+        yield records
+
+
+def import_lines(db: Session, lines, batch: int = BATCH_SIZE):
+    importer = Importer()
+    try:
+        for records in read_batches(lines, batch):
+            importer.feed(db, records)
+    finally:
+        # the batches that did commit still need their counters and caches
+        report = importer.finish(db)
+    return report
+
+
+def main():
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write NDJSON to a file or stdout")
+    export.add_argument("path", nargs="?", default="-")
+    load = commands.add_parser("import", help="read NDJSON from a file or stdin")
+    load.add_argument("path", nargs="?", default="-")
+    for command in (export, load):
+        command.add_argument("--batch", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "export":
+            out = sys.stdout if args.path == "-" else open(args.path, "w", encoding="utf-8")
+            started, rows = time.perf_counter(), 0
+            with out:
+                for line in export_lines(db, args.batch):
+                    out.write(line)
+                    rows += 1
+            elapsed = time.perf_counter() - started
+            print(f"exported {rows} rows in {elapsed:.2f} s ({rows / elapsed:.0f} rows/s)", file=sys.stderr)
+        else:
+            source = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8")
+            with source:
+                report = import_lines(db, source, args.batch)
+            print(json.dumps(report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
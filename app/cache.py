@@ -0,0 +1,267 @@
+"""In-process and shared caches behind one small get/set/delete interface.
+
+TTLCache lives in the worker's memory. RedisCache keeps the entries in Redis
+(or fakeredis, for tests and single-host setups), pickled, so every worker
+sees the same pages and user snapshots and the invalidations done by the crud
+writes reach all of them. settings.cache_backend picks one for the shared
+caches below.
+"""
+import contextvars
+import functools
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+from .config import settings
+
+# set()'s default generation: whatever the group's is at the time of the write
+CURRENT = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire after a time to live.
+
+    With a `group` function it keeps a generation per group, like RedisCache,
+    bumped by delete_prefix() on the group; set() with a generation from
+    before the bump is dropped.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, group=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.group = group
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def lookup(self, key, default=None):
+        # generation first: one bumped after this still drops what's built now
+        generation = self.generation(key)
+        return self.get(key, default), generation
+
+    def generation(self, key):
+        return None if self.group is None else self._generations.get(self.group(key), 0)
+
+    def set(self, key, value, ttl: float | None = None, generation=CURRENT):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not CURRENT and generation != self.generation(key):
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            if self.group is not None and self.group(prefix) == prefix:
+                self._generations[prefix] = self._generations.get(prefix, 0) + 1
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # in memory there is nothing to wait for; these mirror RedisCache's
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def alookup(self, key, default=None):
+        return self.lookup(key, default)
+
+    async def aset(self, key, value, ttl: float | None = None, generation=CURRENT):
+        self.set(key, value, ttl, generation)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+class RedisCache:
+    """TTLCache's interface over a Redis keyspace "<namespace>:<name>:<key>".
+
+    Size is bounded by the TTLs and the server's maxmemory policy rather than
+    an LRU of our own. Values are pickled, so only point this at a Redis that
+    nothing untrusted can write to.
+
+    With a `group` function, delete_prefix() on a group is O(1): every group
+    has a generation counter, entries are stored with the generation they
+    were written under, and dropping the group just bumps its counter, so
+    the old entries read as misses until they expire. Other prefixes fall
+    back to scanning the keyspace.
+
+    A value built from a read (a page rendered from a query) must be stored
+    under the generation from before that read, or an invalidation that
+    lands while it is being built would be lost: lookup() returns the
+    generation along with the entry, and set(..., generation=) stamps it.
+    """
+
+    def __init__(self, client, name: str, ttl: float = 60, namespace: str = "blog", group=None):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = f"{namespace}:{name}:"
+        self.group = group
+        self.hits = 0
+        self.misses = 0
+
+    def generation_key(self, group: str):
+        return f"{self.prefix}generation:{group}"
+
+    def get(self, key, default=None):
+        return self.lookup(key, default)[0]
+
+    def lookup(self, key, default=None):
+        # the entry and the generation of its group, in one round trip
+        if self.group is None:
+            raw, generation = self.client.get(self.prefix + key), None
+        else:
+            raw, generation = self.client.mget(self.prefix + key, self.generation_key(self.group(key)))
+        if raw is not None:
+            written_under, value = pickle.loads(raw)
+            if written_under == generation:
+                self.hits += 1
+                return value, generation
+        self.misses += 1
+        return default, generation
+
+    def generation(self, key):
+        return None if self.group is None else self.client.get(self.generation_key(self.group(key)))
+
+    def set(self, key, value, ttl: float | None = None, generation=CURRENT):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        if generation is CURRENT:
+            generation = self.generation(key)
+        # a generation that has moved on since makes this a miss on arrival
+        self.client.set(self.prefix + key, pickle.dumps((generation, value)), px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        write(self.client.delete, self.prefix + key)
+
+    def delete_prefix(self, prefix: str):
+        if self.group is not None and self.group(prefix) == prefix:
+            write(self.client.incr, self.generation_key(prefix))
+        else:
+            write(self._delete_matching, self.prefix + glob_escape(prefix) + "*")
+
+    def clear(self):
+        self._delete_matching(glob_escape(self.prefix) + "*")
+
+    def _delete_matching(self, pattern):
+        keys = []
+        for key in self.client.scan_iter(match=pattern, count=500):
+            keys.append(key)
+            if len(keys) == 500:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+    async def aget(self, key, default=None):
+        return await run_in_threadpool(self.get, key, default)
+
+    async def alookup(self, key, default=None):
+        return await run_in_threadpool(self.lookup, key, default)
+
+    async def aset(self, key, value, ttl: float | None = None, generation=CURRENT):
+        await run_in_threadpool(self.set, key, value, ttl, generation)
+
+    def stats(self):
+        # counting our keys would mean scanning the whole keyspace
+        return {"hits": self.hits, "misses": self.misses, "size": None, "maxsize": None}
+
+
+# Redis writes made while crud functions run through AsyncSession.run_sync,
+# on the event loop thread; database.run_db sends them to the threadpool
+deferred_writes: contextvars.ContextVar[list | None] = contextvars.ContextVar("deferred_cache_writes", default=None)
+
+
+def write(function, *args):
+    pending = deferred_writes.get()
+    if pending is None:
+        function(*args)
+    else:
+        pending.append(functools.partial(function, *args))
+
+
+def glob_escape(text: str):
+    return re.sub(r"([*?\[\]\\])", r"\\\1", text)
+
+
+def redis_client():
+    if settings.cache_backend == "fakeredis":
+        import fakeredis
+        # one in-process server, shared by every cache of this interpreter
+        return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    import redis
+    return redis.Redis.from_url(settings.redis_url)
+
+
+shared_client = redis_client() if settings.cache_backend in ("redis", "fakeredis") else None
+
+
+def make_cache(name: str, maxsize: int, ttl: float, group=None):
+    if shared_client is None:
+        return TTLCache(maxsize, ttl, group)
+    return RedisCache(shared_client, name, ttl, settings.cache_namespace, group)
+
+
+# Users behind a token subject, as schemas.CurrentUser snapshots
+user_cache = make_cache("user", settings.user_cache_size, settings.user_cache_ttl)
+
+# Verified JWT payloads by token string, each kept until the token's exp.
+# Always per process: verifying a token gives the same answer in every
+# worker, so there is nothing to keep coherent.
+token_cache = TTLCache(settings.token_cache_size)
+
+def page_group(key: str):
+    # the prefixes the invalidate_* functions below drop: "index:", "feed:"
+    # and "post:<id>:"
+    kind, _, rest = key.partition(":")
+    if kind == "post":
+        return f"post:{rest.partition(':')[0]}:"
+    return f"{kind}:"
+
+
+# Rendered anonymous pages and page fragments, see pagecache.py
+page_cache = make_cache("page", settings.page_cache_size, settings.page_cache_ttl, group=page_group)
+
+
+# Rendered feed/sitemap entries, keyed by post id and updated_at, see feeds.py
+feed_cache = make_cache("feed", settings.feed_cache_size, settings.feed_cache_ttl)
+
+
+def invalidate_index_pages():
+    page_cache.delete_prefix("index:")
+
+
+def invalidate_feeds():
+    # the entries are versioned by updated_at, only the documents go stale
+    page_cache.delete_prefix("feed:")
+
+
+def invalidate_post_pages(post_id):
+    page_cache.delete_prefix(f"post:{post_id}:")
@@ -1,16 +1,26 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import select, update, delete, values
+from sqlalchemy import select, insert, update, delete, values, tuple_, func
 
-from . import models, schemas
+from . import avatars, jobs, models, rendering, schemas
+from .cache import user_cache, invalidate_index_pages, invalidate_post_pages, invalidate_feeds
+from .timing import timed
+from .config import settings
 
 import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 # =======================USERS=========================
 
 def register_user(db: Session, user: schemas.User):
     new_user = models.Users(**user.dict())
     db.add(new_user)
+    if new_user.email:
+        # draw the identicon before it's first shown
+        jobs.enqueue(db, "render_avatar", email_hash=avatars.email_hash(new_user.email))
     db.commit()
+    user_cache.delete(new_user.name)
     return True
 
 def get_user_by_email(db: Session, email : str):
@@ -39,62 +49,214 @@ def get_user_by_name(db: Session, username: str):
         return user[0]
     return None
 
+def update_user_password(db: Session, user: models.Users, password_hash: str):
+    db.execute(update(models.Users).where(models.Users.id == user.id).values(password = password_hash))
+    db.commit()
+    user_cache.delete(user.name)
+    return
+
 
 
 # =======================POSTS=========================
 
+POSTS_PAGE_SIZE = 10
+POSTS_PAGE_MAX = 50
+
 def get_all_posts(db: Session):
     return db.scalars(select(models.BlogPost)).all()
 
-def get_post(db: Session, id_post: int):
-    print(id_post)
-    
-    data = db.execute(select(models.BlogPost).where(models.BlogPost.id == id_post)).first()
+def post_previews():
+    # The comment stats are stored on the post itself, so the front page
+    # never has to count comments.
+    return select(
+        models.BlogPost.id,
+        models.BlogPost.title,
+        models.BlogPost.subtitle,
+        models.BlogPost.author,
+        models.BlogPost.date,
+        models.BlogPost.excerpt,
+        models.BlogPost.reading_time,
+        models.BlogPost.comment_count,
+        models.BlogPost.last_comment_at,
+    )
 
+def get_posts_page(db: Session, before: int | None = None, limit: int = POSTS_PAGE_SIZE):
+    # Keyset pagination on the primary key, newest first. Only the columns
+    # shown in the preview are loaded, so the body never leaves the database.
+    limit = max(1, min(limit, POSTS_PAGE_MAX))
+    stmt = post_previews().order_by(models.BlogPost.id.desc()).limit(limit + 1)
+    if before is not None:
+        stmt = stmt.where(models.BlogPost.id < before)
 
-    return data[0]
+    posts = db.execute(stmt).all()
+    next_before = posts[limit - 1].id if len(posts) > limit else None
+    return posts[:limit], next_before
+
+def get_most_active_posts(db: Session, limit: int = POSTS_PAGE_MAX):
+    # Walks ix_blog_post_activity backwards, no sort step
+    limit = max(1, min(limit, POSTS_PAGE_MAX))
+    stmt = post_previews().order_by(
+        models.BlogPost.comment_count.desc(), models.BlogPost.id.desc()
+    ).limit(limit)
+    return db.execute(stmt).all()
+
+def get_feed_entries(db: Session, limit: int | None = None):
+    # Just what the feed and sitemap print, newest first
+    stmt = select(
+        models.BlogPost.id,
+        models.BlogPost.title,
+        models.BlogPost.author,
+        models.BlogPost.excerpt,
+        models.BlogPost.updated_at,
+    ).order_by(models.BlogPost.id.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return db.execute(stmt).all()
+
+def get_post(db: Session, id_post: int):
+    logger.debug("get_post post_id=%s", id_post)
+    return db.get(models.BlogPost, id_post)
 
 def get_post_by_title(db: Session, title: str):
     return db.scalars(select(models.BlogPost).filter(models.BlogPost.title == title)).first()
 
+@timed("crud.create_post")
 def create_post(db: Session, post_data: schemas.EntirePost):
     x = datetime.datetime.now()
     time = f"{x.strftime('%B')} {x.day}, {x.year}"
-    db_post = models.BlogPost(**post_data.dict(), date = time)
-    db.add(db_post)
+    rendered = rendering.render_post(post_data.body)
+    stmt = insert(models.BlogPost).values(**post_data.dict(), **rendered._asdict(), date = time,
+                                          updated_at = datetime.datetime.utcnow())
+    if db.get_bind().dialect.insert_returning:
+        post_id = db.scalar(stmt.returning(models.BlogPost.id))
+    else:
+        post_id = db.execute(stmt).inserted_primary_key[0]
+    warming = refresh_feeds(db)
     db.commit()
-    db.refresh(db_post)
-    return
+    invalidate_index_pages()
+    if not warming:
+        invalidate_feeds()
+    return post_id
 
+@timed("crud.update_post")
 def update_post(db: Session, post_data: schemas.EntirePost, post_id: int):
-    print(post_data.author)
-    db.execute(update(models.BlogPost).where(models.BlogPost.id == post_id).values(
+    logger.debug("update_post post_id=%s author=%r", post_id, post_data.author)
+    result = db.execute(update(models.BlogPost).where(models.BlogPost.id == post_id).values(
         title = post_data.title,
         subtitle = post_data.subtitle,
         body = post_data.body,
         author = post_data.author,
         img_url = post_data.img_url,
-        owner_id = post_data.owner_id
+        owner_id = post_data.owner_id,
+        updated_at = datetime.datetime.utcnow(),
+        **rendering.render_post(post_data.body)._asdict()
     ))
+    warming = refresh_feeds(db)
     db.commit()
-    return
+    invalidate_index_pages()
+    invalidate_post_pages(post_id)
+    if not warming:
+        invalidate_feeds()
+    return post_id if result.rowcount else None
+
+def refresh_feeds(db: Session):
+    # Call before the commit. With settings.site_url the warm_feeds job
+    # rebuilds the feed documents from the committed rows, so they are
+    # dropped now: dropping them after the commit could throw the rebuild
+    # away. Without it nothing is rebuilt and the caller drops them after
+    # the commit instead.
+    if not settings.site_url:
+        return False
+    invalidate_feeds()
+    jobs.enqueue(db, "warm_feeds")
+    return True
 
 def delete_post(db: Session, post_id:str):
 
+        db.execute(delete(models.Comment).where(models.Comment.post_id == post_id))
         db.execute(delete(models.BlogPost).where(models.BlogPost.id == post_id))
+        warming = refresh_feeds(db)
         db.commit()
+        invalidate_index_pages()
+        invalidate_post_pages(post_id)
+        if not warming:
+            invalidate_feeds()
         return True
 
     
 
 # =======================COMMENTS=========================
 
+COMMENTS_PAGE_SIZE = 20
+COMMENTS_PAGE_MAX = 100
+
 def add_comment(db: Session, comment_data: schemas.EntireComment):
     comment = models.Comment(**comment_data.dict())
     db.add(comment)
+    db.flush()
+    comment_id = comment.id
+    # same transaction as the insert, so the counters can't drift
+    db.execute(update(models.BlogPost).where(models.BlogPost.id == comment.post_id).values(
+        comment_count = models.BlogPost.comment_count + 1,
+        last_comment_at = comment.date
+    ))
+    jobs.enqueue(db, "notify_post_owner", comment_id=comment_id)
     db.commit()
-    db.refresh(comment)
-    return
+    invalidate_index_pages()
+    invalidate_post_pages(comment_data.post_id)
+    return comment_id
+
+def post_counters_update():
+    # Recomputes comment_count/last_comment_at for every post in one UPDATE
+    comments = models.Comment.__table__
+    posts = models.BlogPost.__table__
+    return update(posts).values(
+        comment_count = select(func.count()).where(comments.c.post_id == posts.c.id).scalar_subquery(),
+        last_comment_at = select(func.max(comments.c.date)).where(comments.c.post_id == posts.c.id).scalar_subquery()
+    )
+
+def reconcile_post_counters(db: Session):
+    result = db.execute(post_counters_update())
+    db.commit()
+    invalidate_index_pages()
+    return result.rowcount
+
+def comments_with_avatars(post_id: int):
+    return select(
+        models.Comment.id,
+        models.Comment.text,
+        models.Comment.date,
+        models.Comment.owner_id,
+        models.Comment.post_id,
+        models.Users.avatar_url,
+    ).outerjoin(models.Users, models.Users.id == models.Comment.owner_id).where(
+        models.Comment.post_id == post_id
+    ).order_by(models.Comment.date, models.Comment.id)
+
+def encode_comment_cursor(comment):
+    return f"{comment.date.isoformat()}_{comment.id}"
+
+def decode_comment_cursor(cursor: str):
+    # raises ValueError for anything that did not come from encode_comment_cursor
+    date, comment_id = cursor.rsplit("_", 1)
+    return datetime.datetime.fromisoformat(date), int(comment_id)
+
+def get_comments_page(db: Session, post_id: int, after: str | None = None, limit: int = COMMENTS_PAGE_SIZE):
+    # Keyset pagination on (date, id), served by the (post_id, date) index
+    limit = max(1, min(limit, COMMENTS_PAGE_MAX))
+    stmt = comments_with_avatars(post_id).limit(limit + 1)
+    if after is not None:
+        stmt = stmt.where(tuple_(models.Comment.date, models.Comment.id) > tuple_(*decode_comment_cursor(after)))
+
+    comments = db.execute(stmt).all()
+    next_after = encode_comment_cursor(comments[limit - 1]) if len(comments) > limit else None
+    return comments[:limit], next_after
+
+def iter_comments_with_avatars(db: Session, post_id: int):
+    # Rows come from the cursor in batches of settings.comments_stream_batch
+    # (a server-side cursor on Postgres) instead of one list of the whole thread.
+    stmt = comments_with_avatars(post_id).execution_options(yield_per=settings.comments_stream_batch)
+    yield from db.execute(stmt)
 
 def get_comments_to_post(db: Session, post_id: int):
     stmt = select(models.Comment).filter(models.Comment.post_id == post_id).order_by(models.Comment.date)
@@ -0,0 +1,129 @@
+"""Atom feed and XML sitemap, built from cached pieces.
+
+Both documents come from crud.get_feed_entries, a projection of the few
+columns they print. Each post's <entry>/<url> element is rendered once and
+kept in cache.feed_cache under its id and updated_at, so an edit produces a
+new key and the old one simply ages out. The assembled documents are stored
+like any other page (pagecache, with ETag/Last-Modified) and dropped by
+cache.invalidate_feeds() whenever create_post/update_post/delete_post run;
+rebuilding one then only renders the entries that changed.
+"""
+from xml.sax.saxutils import escape, quoteattr
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, database, pagecache
+from .cache import feed_cache
+from .config import settings
+
+FEED_TITLE = "Lukas Blog"
+FEED_SUBTITLE = "A boring blog for learning coding."
+STATIC_PAGES = ("", "about", "contact")
+# the most URLs a single sitemap file may list
+SITEMAP_LIMIT = 50000
+
+ATOM_TYPE = "application/atom+xml"
+SITEMAP_TYPE = "application/xml"
+
+
+def base_url(request: Request):
+    return (settings.site_url or str(request.base_url)).rstrip("/") + "/"
+
+
+def timestamp(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ") if value else None
+
+
+def cached_element(kind, base, post, render):
+    # full precision, two edits in the same second must not share a key
+    version = post.updated_at.isoformat() if post.updated_at else None
+    key = f"{kind}:{base}:{post.id}:{version}"
+    element = feed_cache.get(key)
+    if element is None:
+        element = render(base, post)
+        feed_cache.set(key, element)
+    return element
+
+
+def atom_entry(base, post):
+    link = f"{base}post/{post.id}"
+    return (
+        "<entry>"
+        f"<title>{escape(post.title)}</title>"
+        f"<link href={quoteattr(link)}/>"
+        f"<id>{escape(link)}</id>"
+        f"<updated>{timestamp(post.updated_at)}</updated>"
+        f"<author><name>{escape(post.author)}</name></author>"
+        f"<summary>{escape(post.excerpt or '')}</summary>"
+        "</entry>"
+    )
+
+
+def sitemap_url(base, post):
+    lastmod = f"<lastmod>{timestamp(post.updated_at)}</lastmod>" if post.updated_at else ""
+    return f"<url><loc>{escape(f'{base}post/{post.id}')}</loc>{lastmod}</url>"
+
+
+def build_atom(base, posts):
+    updated = max((post.updated_at for post in posts if post.updated_at), default=None)
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<feed xmlns="http://www.w3.org/2005/Atom">',
+        f"<title>{escape(FEED_TITLE)}</title>",
+        f"<subtitle>{escape(FEED_SUBTITLE)}</subtitle>",
+        f'<link href={quoteattr(base + "feed.xml")} rel="self"/>',
+        f"<link href={quoteattr(base)}/>",
+        f"<id>{escape(base)}</id>",
+        f"<updated>{timestamp(updated) or '1970-01-01T00:00:00Z'}</updated>",
+    ]
+    parts.extend(cached_element("atom", base, post, atom_entry) for post in posts)
+    parts.append("</feed>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def build_sitemap(base, posts):
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+    ]
+    parts.extend(f"<url><loc>{escape(base + page)}</loc></url>" for page in STATIC_PAGES)
+    parts.extend(cached_element("sitemap", base, post, sitemap_url) for post in posts)
+    parts.append("</urlset>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def entry_limit(kind: str):
+    return settings.feed_entries if kind == "atom" else SITEMAP_LIMIT - len(STATIC_PAGES)
+
+
+def render(kind: str, base: str, posts):
+    return build_atom(base, posts) if kind == "atom" else build_sitemap(base, posts)
+
+
+def build(db, kind: str, base: str):
+    return render(kind, base, crud.get_feed_entries(db, entry_limit(kind)))
+
+
+async def respond(request: Request, db, kind: str):
+    base = base_url(request)
+    key = f"feed:{kind}:{base}"
+    page, generation = await pagecache.aget_page(key)
+    if page is None:
+        posts = await database.run_db(db, crud.get_feed_entries, entry_limit(kind))
+        # feed_cache lookups, kept off the event loop like the query
+        body = await run_in_threadpool(render, kind, base, posts)
+        page = await pagecache.astore_page(key, body, generation)
+    return pagecache.page_response(request, page, ATOM_TYPE if kind == "atom" else SITEMAP_TYPE)
+
+
+def warm(db):
+    # Rebuilds both documents ahead of the next crawler (the warm_feeds job).
+    # Only possible with settings.site_url, otherwise the host isn't known.
+    if not settings.site_url:
+        return
+    base = settings.site_url.rstrip("/") + "/"
+    for kind in ("atom", "sitemap"):
+        key = f"feed:{kind}:{base}"
+        generation = pagecache.generation(key)
+        pagecache.store_page(key, build(db, kind, base), generation)
@@ -0,0 +1,339 @@
+"""Background jobs for the follow-up work of a write.
+
+A crud write calls enqueue() before its own commit, so the job row lands
+in the same transaction as the change it follows up on (and disappears with
+it on a rollback). Jobs live in the app's database, in the `jobs` table,
+and survive restarts.
+
+A pool of settings.jobs_workers asyncio tasks, started with the app, claims
+due jobs with a conditional UPDATE (safe with several processes on one
+database) and runs their handlers in the threadpool, each with a session
+of its own. A failing job is retried with exponential backoff until it has
+used its max_attempts, then stays "failed" for inspection at GET /jobs.
+Jobs whose worker died while running them are picked up again once
+settings.jobs_lock_timeout has passed.
+
+Handlers are plain functions registered with @task, taking a session and
+the JSON payload as keyword arguments:
+
+    @task("notify_post_owner")
+    def notify_post_owner(db, comment_id): ...
+
+    jobs.enqueue(db, "notify_post_owner", comment_id=comment.id)
+
+Enqueueing is a single INSERT. Tasks registered with unique=True are
+deduplicated when claimed instead: the due copies of the same job are
+marked done along with it, since the one run covers them all.
+
+With settings.jobs_sync (tests) there are no workers: every commit that
+enqueued something runs the queue to empty before returning, and drain()
+does the same on demand.
+"""
+import asyncio
+import contextvars
+import datetime
+import json
+import logging
+import smtplib
+import threading
+import traceback
+from email.message import EmailMessage
+from typing import Callable, NamedTuple
+
+from sqlalchemy import and_, delete, event, func, or_, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import avatars, cache, models
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# longest wait between two attempts of a failing job
+MAX_RETRY_DELAY = 3600
+# how often an idle worker clears out finished jobs
+PURGE_INTERVAL = 600
+
+
+class Task(NamedTuple):
+    function: Callable
+    max_attempts: int
+    unique: bool
+
+
+class ClaimedJob(NamedTuple):
+    id: int
+    name: str
+    payload: str
+    attempts: int
+    max_attempts: int
+
+
+TASKS: dict[str, Task] = {}
+
+
+def task(name: str, max_attempts: int = 5, unique: bool = False):
+    def decorator(function):
+        TASKS[name] = Task(function, max_attempts, unique)
+        return function
+    return decorator
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+# =======================QUEUE=========================
+
+def enqueue(db: Session, name: str, *, delay: float = 0, **payload):
+    # Nothing is committed here; the job is saved by the caller's commit
+    if name not in TASKS:
+        raise KeyError(f"unknown job {name!r}")
+    now = utcnow()
+    job = models.Job(name=name, payload=json.dumps(payload, sort_keys=True), status="pending", attempts=0,
+                     max_attempts=TASKS[name].max_attempts,
+                     run_at=now + datetime.timedelta(seconds=delay), created_at=now)
+    db.add(job)
+    if not db.info.get("jobs_pending_wake"):
+        db.info["jobs_pending_wake"] = True
+        event.listen(db, "after_commit", after_commit, once=True)
+    return job
+
+
+def after_commit(db: Session):
+    db.info.pop("jobs_pending_wake", None)
+    # queued behind any cache invalidation run_db is holding back, so a job
+    # never starts before the caches it rebuilds were dropped
+    cache.write(wake)
+
+
+def wake():
+    if settings.jobs_sync:
+        drain()
+    elif worker is not None:
+        worker.wake()
+
+
+def claim(ignore_schedule: bool = False):
+    Job = models.Job
+    now = utcnow()
+    due = Job.status == "pending"
+    if not ignore_schedule:
+        due = and_(due, Job.run_at <= now)
+    abandoned = and_(Job.status == "running",
+                     Job.locked_at < now - datetime.timedelta(seconds=settings.jobs_lock_timeout))
+    claimable = or_(due, abandoned)
+
+    with SessionLocal() as db:
+        candidates = db.scalars(select(Job.id).where(claimable).order_by(Job.run_at, Job.id).limit(10)).all()
+        for job_id in candidates:
+            # another worker may have taken it since the select
+            result = db.execute(update(Job).where(Job.id == job_id, claimable).values(
+                status="running", attempts=Job.attempts + 1, locked_at=now))
+            if result.rowcount:
+                job = ClaimedJob(*db.execute(select(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts)
+                                             .where(Job.id == job_id)).one())
+                registered = TASKS.get(job.name)
+                if registered is not None and registered.unique:
+                    db.execute(update(Job).where(
+                        Job.name == job.name, Job.payload == job.payload, Job.status == "pending",
+                        Job.run_at <= now, Job.id != job.id,
+                    ).values(status="done", finished_at=now))
+                db.commit()
+                return job
+        db.rollback()
+    return None
+
+
+def execute(job: ClaimedJob):
+    try:
+        handler = TASKS[job.name].function
+        with SessionLocal() as db:
+            handler(db, **json.loads(job.payload))
+    except Exception:
+        error = traceback.format_exc()
+        retry = job.attempts < job.max_attempts
+        logger.warning("job failed id=%s name=%s attempt=%s/%s retry=%s",
+                       job.id, job.name, job.attempts, job.max_attempts, retry, exc_info=True)
+        finish(job.id, error, retry_after=retry_delay(job.attempts) if retry else None)
+        return False
+    finish(job.id)
+    return True
+
+
+def retry_delay(attempts: int):
+    return min(settings.jobs_retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def finish(job_id: int, error: str | None = None, retry_after: float | None = None):
+    now = utcnow()
+    if error is None:
+        values = {"status": "done", "finished_at": now, "locked_at": None}
+    elif retry_after is not None:
+        values = {"status": "pending", "run_at": now + datetime.timedelta(seconds=retry_after),
+                  "locked_at": None, "last_error": error}
+    else:
+        values = {"status": "failed", "finished_at": now, "locked_at": None, "last_error": error}
+    with SessionLocal() as db:
+        db.execute(update(models.Job).where(models.Job.id == job_id).values(**values))
+        db.commit()
+
+
+_draining = threading.local()
+
+
+def drain(limit: int = 10000):
+    """Run queued jobs in this thread until none is left, retries included."""
+    # in a context of its own, so the jobs' statements aren't counted
+    # against the request that happened to commit (metrics, querybudget)
+    return contextvars.Context().run(_drain, limit)
+
+
+def _drain(limit: int):
+    if getattr(_draining, "active", False):
+        # a job enqueued more work; the outer loop will get to it
+        return 0
+    _draining.active = True
+    try:
+        ran = 0
+        while ran < limit:
+            job = claim(ignore_schedule=True)
+            if job is None:
+                break
+            execute(job)
+            ran += 1
+        return ran
+    finally:
+        _draining.active = False
+
+
+def purge(older_than: float | None = None):
+    cutoff = utcnow() - datetime.timedelta(seconds=settings.jobs_keep_done if older_than is None else older_than)
+    with SessionLocal() as db:
+        result = db.execute(delete(models.Job).where(models.Job.status == "done", models.Job.finished_at < cutoff))
+        db.commit()
+        return result.rowcount
+
+
+def inspect(db: Session, status: str | None = None, limit: int = 50):
+    Job = models.Job
+    counts = {}
+    for name, job_status, count in db.execute(
+            select(Job.name, Job.status, func.count()).group_by(Job.name, Job.status)):
+        counts.setdefault(name, {})[job_status] = count
+    stmt = select(Job.id, Job.name, Job.payload, Job.status, Job.attempts, Job.max_attempts,
+                  Job.run_at, Job.created_at, Job.finished_at, Job.last_error).order_by(Job.id.desc()).limit(limit)
+    if status is not None:
+        stmt = stmt.where(Job.status == status)
+    return {"counts": counts, "jobs": [dict(row._mapping) for row in db.execute(stmt)]}
+
+
+# =======================WORKERS=========================
+
+class Worker:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.tasks = []
+        self.loop = None
+        self.event = None
+        self.stopping = False
+        self.last_purge = 0.0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    def wake(self):
+        # called from threadpool threads, after the enqueueing commit
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    async def run(self):
+        while not self.stopping:
+            self.event.clear()
+            try:
+                job = await run_in_threadpool(claim)
+                if job is not None:
+                    await run_in_threadpool(execute, job)
+                    continue
+                if self.loop.time() - self.last_purge > PURGE_INTERVAL:
+                    self.last_purge = self.loop.time()
+                    await run_in_threadpool(purge)
+            except Exception:
+                # the database being briefly unavailable shouldn't end the worker
+                logger.exception("job worker error")
+            try:
+                await asyncio.wait_for(self.event.wait(), settings.jobs_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, timeout: float = 10):
+        self.stopping = True
+        self.event.set()
+        done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        for running in pending:
+            running.cancel()
+
+
+worker: Worker | None = None
+
+
+async def start():
+    global worker
+    if settings.jobs_sync or settings.jobs_workers <= 0:
+        return
+    worker = Worker(settings.jobs_workers)
+    worker.start()
+
+
+async def stop():
+    global worker
+    if worker is not None:
+        await worker.stop()
+        worker = None
+
+
+# =======================TASKS=========================
+
+def send_mail(to: str, subject: str, text: str):
+    if not settings.smtp_host:
+        logger.info("mail (no smtp_host configured) to=%s subject=%r", to, subject)
+        return
+    message = EmailMessage()
+    message["From"] = settings.mail_from
+    message["To"] = to
+    message["Subject"] = subject
+    message.set_content(text)
+    with smtplib.SMTP(settings.smtp_host, settings.smtp_port, timeout=30) as smtp:
+        smtp.send_message(message)
+
+
+@task("notify_post_owner")
+def notify_post_owner(db: Session, comment_id: int):
+    owner = models.Users
+    row = db.execute(
+        select(models.Comment.text, models.Comment.owner_id, models.BlogPost.id.label("post_id"),
+               models.BlogPost.title, owner.id.label("owner_id_of_post"), owner.email, owner.name)
+        .join(models.BlogPost, models.BlogPost.id == models.Comment.post_id)
+        .join(owner, owner.id == models.BlogPost.owner_id)
+        .where(models.Comment.id == comment_id)
+    ).first()
+    # gone, or the owner answering on their own post
+    if row is None or not row.email or row.owner_id == row.owner_id_of_post:
+        return
+    link = f"{settings.site_url.rstrip('/')}/post/{row.post_id}" if settings.site_url else f"/post/{row.post_id}"
+    send_mail(row.email, f"New comment on {row.title}",
+              f"Hi {row.name},\n\nsomeone commented on \"{row.title}\":\n\n{row.text}\n\n{link}\n")
+
+
+@task("warm_feeds", unique=True)
+def warm_feeds(db: Session):
+    from . import feeds
+    feeds.warm(db)
+
+
+@task("render_avatar")
+def render_avatar(db: Session, email_hash: str):
+    avatars.get_avatar(email_hash)
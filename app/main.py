@@ -3,72 +3,152 @@ from typing import List
 from fastapi import Depends, FastAPI, HTTPException, Request, Form, status
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas, security, database
+from . import crud, schemas, security, database, migrate, pagecache, search, assets, avatars, templating, metrics, querybudget, bulk, feeds, jobs, ratelimit
 from .database import SessionLocal, engine
+from .config import settings
+from .templating import templates
 
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette_wtf import CSRFProtectMiddleware, csrf_protect
 
-from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta, datetime
 
-import urllib, hashlib
+import urllib
+import logging
 
-models.Base.metadata.create_all(bind=engine)
+logging.basicConfig(level=settings.log_level.upper(), format=settings.log_format)
+
+for instrument in (metrics.instrument_engine, querybudget.instrument_engine):
+    instrument(engine)
+    if settings.async_db:
+        instrument(database.async_engine)
+
+migrate.upgrade(engine)
 
 app = FastAPI(middleware=[
+    Middleware(metrics.MetricsMiddleware),
+    Middleware(ratelimit.RateLimitMiddleware),
+    Middleware(querybudget.QueryBudgetMiddleware),
     Middleware(SessionMiddleware, secret_key='***REPLACEME1***'),
     Middleware(CSRFProtectMiddleware, csrf_secret='***REPLACEME2***')
 ])
 
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+app.mount("/static", assets.AssetStaticFiles(directory="static"), name="static")
+
+
+@app.on_event("startup")
+def warm_up_templates():
+    if settings.templates_production:
+        templating.warm_up(app)
+
+
+@app.on_event("startup")
+async def start_jobs():
+    await jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop()
+
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 
+def stream_post_page(request, post, current_user, generation=None):
+    # The header and post body go out before the first comment is read; the
+    # comments come from their own session because the response outlives
+    # the request's dependencies.
+    def comments():
+        with SessionLocal() as stream_db:
+            yield from crud.iter_comments_with_avatars(stream_db, post.id)
 
-def get_gravatar_url(email, size=100, default='identicon', rating='g'):
-    email_hash = hashlib.md5(email.lower().encode('utf-8')).hexdigest()
-    gravatar_url = f"https://www.gravatar.com/avatar/{email_hash}?s={size}&d={default}&r={rating}"
-    return gravatar_url
+    context = {"request": request, "requested_post": post, "logged_in": current_user, "comments": comments()}
+    chunks = templating.stream("post.html", context)
+    if current_user is None:
+        chunks = pagecache.store_streamed_page(pagecache.post_key(post.id), chunks, generation)
+    return StreamingResponse(chunks, media_type="text/html")
+
+
+def render_comments(post_id, comments, next_after):
+    return templates.get_template("comments_page.html").render(
+        post_id=post_id, comments=comments, next_comments=next_after)
 
 
 # Security path
+def issue_access_token(user):
+    access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
+    return security.create_access_token(
+        data={"sub": user.name}, expires_delta=access_token_expires
+    )
+
 @app.post("/token", response_model=schemas.Token)
+@querybudget.budget(2)
 async def login_for_access_token(request: Request, 
                                  form_data: OAuth2PasswordRequestForm = Depends(), 
                                  db:Session = Depends(database.get_db)):
-    user = security.authenticate_user(form_data.username, form_data.password, db)
+    user = await security.authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = security.create_access_token(
-        data={"sub": user.name}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {"access_token": issue_access_token(user), "token_type": "bearer"}
 
 
 # Endpoints
 
 @app.get('/')
-def get_all_posts(request:Request, 
+@querybudget.budget(2)
+async def get_all_posts(request:Request, 
+                  before: int | None = None,
+                  limit: int = crud.POSTS_PAGE_SIZE,
+                  sort: str = "recent",
                   db: Session = Depends(database.get_db),
                   current_user: schemas.User = Depends(security.get_current_user)):
     if current_user == "expired":
         current_user = None
 
-    posts = crud.get_all_posts(db)
+    generation = None
+    if current_user is None:
+        page, generation = await pagecache.aget_page(pagecache.index_key(request))
+        if page:
+            return pagecache.page_response(request, page)
+
+    if sort == "active":
+        posts, next_before = await database.run_db(db, crud.get_most_active_posts), None
+    else:
+        posts, next_before = await database.run_db(db, crud.get_posts_page, before=before, limit=limit)
+
+    response = templates.TemplateResponse("index.html", {"request": request, "all_posts":posts, "next_before": next_before, "limit": limit, "sort": sort, "logged_in" : current_user})
+    if current_user is None:
+        page = await pagecache.astore_page(pagecache.index_key(request), response.body, generation)
+        return pagecache.page_response(request, page)
+    return response
+
+@app.get("/search")
+@querybudget.budget(2)
+async def search_posts(request:Request,
+                       q: str = "",
+                       page: int = 1,
+                       db: Session = Depends(database.get_db),
+                       current_user: schemas.User = Depends(security.get_current_user)):
+    if current_user == "expired":
+        current_user = None
+
+    results, has_next = await database.run_db(db, search.search, q, page)
 
-    return templates.TemplateResponse("index.html", {"request": request, "all_posts":posts, "logged_in" : current_user})
+    return templates.TemplateResponse("search.html", {"request": request, "q": q, "page": page, "results": results, "has_next": has_next, "logged_in": current_user})
 
 @app.get("/about")
 def about(request:Request):
@@ -80,6 +160,17 @@ def contact(request:Request):
     return templates.TemplateResponse("contact.html", {'request':request})
 
 
+@app.get("/feed.xml")
+@querybudget.budget(1)
+async def atom_feed(request: Request, db: Session = Depends(database.get_db)):
+    return await feeds.respond(request, db, "atom")
+
+@app.get("/sitemap.xml")
+@querybudget.budget(1)
+async def sitemap(request: Request, db: Session = Depends(database.get_db)):
+    return await feeds.respond(request, db, "sitemap")
+
+
 # USERS SERVICE
 
 @app.get('/login')
@@ -87,6 +178,7 @@ def login(request:Request):
     return templates.TemplateResponse("login.html", {"request": request,"user":"", "msg":""})
 
 @app.post('/login')
+@querybudget.budget(3)
 async def login(request:Request,
           form: schemas.UserBase = Depends(schemas.UserBase.login_as_form),
           db: Session = Depends(database.get_db)):
@@ -99,23 +191,23 @@ async def login(request:Request,
     elif not form.password:
         msg = "Please insert password"
 
-    elif not crud.get_user_by_name(db, form.email):
+    elif not await database.run_db(db, crud.get_user_by_name, form.email):
         msg = "This user doesn't exist"
     
 
-    elif not security.authenticate_user(form.email, form.password, db):
+    elif not (user := await security.authenticate_user(form.email, form.password, db)):
         msg = "Invalid login or password"
 
     else:
-        user_oath = schemas.baseaccount_to_oath(form)
-        token = await login_for_access_token(request=request, form_data=user_oath, db=db)
-
-        if token:
-            redirect_url = request.url_for('get_all_posts')
-            response = RedirectResponse(redirect_url)
-            response.set_cookie(key="access_token",value= f"Bearer {token['access_token']}", secure=True, httponly=True)
-            response.status_code = 302  
-            return response
+        # the password was checked just above, so the token is issued directly
+        # instead of going through /token and paying for bcrypt a second time
+        token = issue_access_token(user)
+
+        redirect_url = request.url_for('get_all_posts')
+        response = RedirectResponse(redirect_url)
+        response.set_cookie(key="access_token",value= f"Bearer {token}", secure=True, httponly=True)
+        response.status_code = 302  
+        return response
 
     return templates.TemplateResponse("login.html", {"request": request,"user":"", "msg":msg})
 
@@ -127,7 +219,8 @@ def register(request:Request):
     return templates.TemplateResponse("register.html", {"request": request,"user":user, "msg":msg})
 
 @app.post('/register')
-def register(request:Request, 
+@querybudget.budget(5)
+async def register(request:Request, 
              db:Session = Depends(database.get_db), 
              user:schemas.User = Depends(schemas.User.register_as_form)):
     msg=""
@@ -140,14 +233,14 @@ def register(request:Request,
 
     elif not user.email:
         msg = "Please insert email"
-    elif crud.get_user_by_email(db, user.email):
+    elif await database.run_db(db, crud.get_user_by_email, user.email):
         msg = "Email in data base already exist."
 
-    elif not crud.get_user_by_name(db, user.name):
-        user.password = security.get_password_hash(user.password)
-        user.avatar_url = get_gravatar_url(user.email)
+    elif not await database.run_db(db, crud.get_user_by_name, user.name):
+        user.password = await security.get_password_hash_async(user.password)
+        user.avatar_url = avatars.avatar_url(user.email)
         
-        if crud.register_user(db, user):            
+        if await database.run_db(db, crud.register_user, user):            
             redirect_url = request.url_for('login')
             response = RedirectResponse(redirect_url)
             response.status_code = 302
@@ -168,9 +261,26 @@ async def logout():
     response.delete_cookie("session")
     return response
 
+@app.get("/avatar/{email_hash}")
+@querybudget.budget(0)
+async def avatar(request: Request, email_hash: str, s: int = avatars.DEFAULT_SIZE):
+    if not avatars.HASH_PATTERN.match(email_hash):
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    image_format = "webp" if "image/webp" in request.headers.get("accept", "") else "png"
+    data, image_format = await run_in_threadpool(avatars.get_avatar, email_hash, s, image_format)
+
+    # the image is a pure function of the hash and size, so it never changes
+    etag = f'"{email_hash}-{s}-{image_format}"'
+    headers = {"ETag": etag, "Cache-Control": assets.IMMUTABLE, "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type=f"image/{image_format}", headers=headers)
+
 # HANDLING POST
 
 @app.get("/post/{index}")
+@querybudget.budget(3)
 async def show_post(request: Request, 
                     index:int, 
                     db:Session = Depends(database.get_db), 
@@ -179,37 +289,47 @@ async def show_post(request: Request,
     if current_user == "expired":
         current_user = None
 
-    requested_post = None
-    posts = crud.get_all_posts(db)
-    for blog_post in posts:
-        #This can be replace by crud
-        if blog_post.id == index:
-            requested_post = blog_post
+    generation = None
+    if current_user is None:
+        page, generation = await pagecache.aget_page(pagecache.post_key(index))
+        if page:
+            return pagecache.page_response(request, page)
 
-    comments = crud.get_comments_to_post(db= db, post_id= requested_post.id)
-    comments = [item[0] for item in comments]
+    if settings.stream_post_pages:
+        requested_post = await database.run_db(db, crud.get_post, index)
+        if requested_post is None:
+            raise HTTPException(status_code=404, detail="Post not found")
+        return stream_post_page(request, requested_post, current_user, generation)
 
-    for i in range(len(comments)):
-        avatar = crud.get_user_by_id(db=db, id=comments[i].owner_id).avatar_url
-        comments[i].avatar_url = avatar
-        comments[i] = schemas.AvatarComment(**comments[i].__dict__)
+    requested_post = await database.run_db(db, crud.get_post, index)
+    if requested_post is None:
+        raise HTTPException(status_code=404, detail="Post not found")
 
-    return templates.TemplateResponse("post.html", {"request": request, 'requested_post': requested_post, "logged_in": current_user, "comments": comments})
+    # Logged-in views only render their own header, the first page of
+    # comments is shared
+    comments_html, comments_generation = await pagecache.aget_fragment(pagecache.comments_key(index))
+    if comments_html is None:
+        comments, next_after = await database.run_db(db, crud.get_comments_page, index)
+        comments_html = await pagecache.astore_fragment(pagecache.comments_key(index), render_comments(index, comments, next_after), comments_generation)
+
+    response = templates.TemplateResponse("post.html", {"request": request, 'requested_post': requested_post, "logged_in": current_user, "comments_html": comments_html})
+    if current_user is None:
+        page = await pagecache.astore_page(pagecache.post_key(index), response.body, generation)
+        return pagecache.page_response(request, page)
+    return response
 
 @app.post("/post/{index}")
 @security.expired_redirection
+@querybudget.budget(5)
 async def send_comment(request: Request, 
                        index:int, 
                        db: Session = Depends(database.get_db), 
                        comment:schemas.CommentText = Depends(schemas.CommentText.as_form), 
                        current_user: schemas.User = Depends(security.get_current_user_required)):
 
-    requested_post = None
-    posts = crud.get_all_posts(db)
-    for blog_post in posts:
-        #This can be replace by crud
-        if blog_post.id == index:
-            requested_post = blog_post
+    requested_post = await database.run_db(db, crud.get_post, index)
+    if requested_post is None:
+        raise HTTPException(status_code=404, detail="Post not found")
 
     dt =datetime.now()
     comment_model = schemas.EntireComment(
@@ -219,17 +339,32 @@ async def send_comment(request: Request,
         owner_id = current_user.id,
         post_id = requested_post.id
         )
-    crud.add_comment(db=db, comment_data=comment_model) 
-
-    comments = crud.get_comments_to_post(db= db, post_id= requested_post.id)
-    comments = [item[0] for item in comments]
-
-    for i in range(len(comments)):
-        avatar = crud.get_user_by_id(db=db, id=comments[i].owner_id).avatar_url
-        comments[i].avatar_url = avatar
-        comments[i] = schemas.AvatarComment(**comments[i].__dict__)
-
-    return templates.TemplateResponse("post.html", {"request": request, 'requested_post': requested_post, "logged_in": current_user, "comments": comments})
+    comment_id = await database.run_db(db, crud.add_comment, comment_data=comment_model)
+
+    # Only the new comment goes back; pages without JavaScript are redirected
+    # to the post instead of re-rendering the whole thread here.
+    new_comment = schemas.AvatarComment(**comment_model.dict(), id=comment_id, avatar_url=current_user.avatar_url)
+    if "application/json" in request.headers.get("accept", ""):
+        return {"comment": new_comment}
+    if request.headers.get("x-requested-with") == "fetch":
+        return HTMLResponse(templates.get_template("comments.html").render(comments=[new_comment]))
+    return RedirectResponse(url=f"/post/{index}", status_code=status.HTTP_303_SEE_OTHER)
+
+@app.get("/post/{index}/comments")
+@querybudget.budget(2)
+async def post_comments(index: int,
+                        after: str | None = None,
+                        limit: int = crud.COMMENTS_PAGE_SIZE,
+                        format: str = "html",
+                        db: Session = Depends(database.get_db)):
+    try:
+        comments, next_after = await database.run_db(db, crud.get_comments_page, index, after=after, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid comments cursor")
+
+    if format == "json":
+        return {"comments": [comment._asdict() for comment in comments], "next": next_after}
+    return HTMLResponse(render_comments(index, comments, next_after))
 
 
 
@@ -237,11 +372,12 @@ async def send_comment(request: Request,
 # @security.admin_privilages
 @security.expired_redirection
 @security.owner_privilages
+@querybudget.budget(5)
 async def delete_post(id = int, 
                       db:Session = Depends(database.get_db), 
                       current_user:schemas.User = Depends(security.get_current_user_required)):
     
-    if crud.delete_post(db,id) == False:
+    if await database.run_db(db, crud.delete_post, id) == False:
         raise HTTPException(status_code=404, detail="Post not found")
     else:
         pass
@@ -262,6 +398,7 @@ async def new_post(request:Request,
 
 @app.post("/new_post/")
 @security.expired_redirection
+@querybudget.budget(3)
 async def new_post(request:Request,
                    db: Session = Depends(database.get_db), 
                    body_text: schemas.PostBase = Depends(schemas.PostBase.as_form),
@@ -280,9 +417,8 @@ async def new_post(request:Request,
             owner_id = current_user.id
         )
 
-        crud.create_post(db=db, post_data=post_data)
-        post = crud.get_post_by_title(db, post_data.title)
-        response = RedirectResponse(url=f'/post/{post.id}')
+        post_id = await database.run_db(db, crud.create_post, post_data=post_data)
+        response = RedirectResponse(url=f'/post/{post_id}')
         response.status_code = 302
         return response
 
@@ -294,11 +430,12 @@ async def new_post(request:Request,
 # @security.admin_privilages
 @security.expired_redirection
 @security.owner_privilages
+@querybudget.budget(2)
 async def edit_post(request:Request, 
                     id : int, 
                     db : Session = Depends(database.get_db), 
                     current_user:schemas.User = Depends(security.get_current_user_required)):
-    crud_data = crud.get_post(db, id)
+    crud_data = await database.run_db(db, crud.get_post, id)
     form = await schemas.CreatePostForm.from_formdata(request)
     form.title.data = crud_data.title
     form.subtitle.data = crud_data.subtitle
@@ -314,6 +451,7 @@ async def edit_post(request:Request,
 # @security.admin_privilages
 @security.expired_redirection
 @security.owner_privilages
+@querybudget.budget(4)
 async def edit_post(request:Request, 
                     id: int, 
                     db: Session = Depends(database.get_db), 
@@ -333,12 +471,66 @@ async def edit_post(request:Request,
             owner_id = current_user.id
         )
 
-        crud.update_post(db, post_data, id)
-        post = crud.get_post_by_title(db, post_data.title)
-        response = RedirectResponse(url=f'/post/{post.id}')
+        post_id = await database.run_db(db, crud.update_post, post_data, id)
+        if post_id is None:
+            raise HTTPException(status_code=404, detail="Post not found")
+        response = RedirectResponse(url=f'/post/{post_id}')
         response.status_code = 302
         return response
 
     return templates.TemplateResponse('make-post.html', {'request':request, "form":form, "body_text":body_text, "editing":editing})
 
 
+# BULK IMPORT / EXPORT
+
+@app.get("/export.ndjson", dependencies=[Depends(security.require_bulk_token)])
+@querybudget.budget(None)
+def export_ndjson():
+    # its own session, like stream_post_page, since the body outlives the handler
+    def lines():
+        with SessionLocal() as export_db:
+            yield from bulk.export_lines(export_db)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="blog.ndjson"'})
+
+@app.post("/import", dependencies=[Depends(security.require_bulk_token)])
+@querybudget.budget(None)
+async def import_ndjson(request: Request,
+                        batch: int = bulk.BATCH_SIZE,
+                        db: Session = Depends(database.get_db)):
+    # Lines are parsed as the body arrives and written a batch at a time, so
+    # the upload is never held in memory as a whole
+    importer = bulk.Importer()
+    buffer, number, records = b"", 0, []
+    try:
+        async for chunk in request.stream():
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                number += 1
+                if line.strip():
+                    records.append(bulk.parse_line(line, number))
+            if len(records) >= batch:
+                await database.run_db(db, importer.feed, records)
+                records = []
+        if buffer.strip():
+            records.append(bulk.parse_line(buffer, number + 1))
+        if records:
+            await database.run_db(db, importer.feed, records)
+    except bulk.BulkImportError as error:
+        await database.run_db(db, importer.finish)
+        return JSONResponse({"detail": str(error), **importer.report()}, status_code=400)
+    except Exception:
+        # the batches that did commit still need their counters and caches
+        await database.run_db(db, importer.finish)
+        raise
+    return await database.run_db(db, importer.finish)
+
+
+
+# BACKGROUND JOBS
+
+@app.get("/jobs", dependencies=[Depends(security.require_bulk_token)])
+@querybudget.budget(2)
+async def list_jobs(status: str | None = None, limit: int = 50, db: Session = Depends(database.get_db)):
+    return await database.run_db(db, jobs.inspect, status, min(limit, 500))
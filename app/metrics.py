@@ -0,0 +1,213 @@
+"""Request, SQL and template instrumentation exposed in Prometheus format.
+
+MetricsMiddleware times every request under its route template
+("/post/{index}", not "/post/17"). SQL statements executed while a request
+is being handled are counted and timed through engine events and charged
+to that request. Templates report their own render time. GET /metrics
+serves all of it, together with the cache and @timed statistics, in the
+Prometheus text format.
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+from .cache import page_cache, token_cache, user_cache
+from .timing import timings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class HistogramFamily:
+    """Histograms keyed by their label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.children: dict[tuple, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            histogram = self.children.get(label_values)
+            if histogram is None:
+                histogram = self.children[label_values] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            children = [(key, list(h.counts), h.sum, h.count) for key, h in self.children.items()]
+        for label_values, counts, total, count in sorted(children):
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{{{labels}{',' if labels else ''}le=\"{le}\"}} {cumulative}"
+            yield f"{self.name}_sum{{{labels}}} {total}"
+            yield f"{self.name}_count{{{labels}}} {count}"
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_seconds = HistogramFamily(
+    "blog_request_duration_seconds", "Request latency by route template.",
+    ("method", "route", "status"))
+request_sql_statements = HistogramFamily(
+    "blog_request_sql_statements", "SQL statements executed per request.",
+    ("method", "route"), QUERY_COUNT_BUCKETS)
+request_sql_seconds = HistogramFamily(
+    "blog_request_sql_duration_seconds", "Time spent in SQL per request.",
+    ("method", "route"))
+template_seconds = HistogramFamily(
+    "blog_template_render_seconds", "Template render time.", ("template",))
+
+
+# ======================= SQL =========================
+
+class RequestStats:
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+
+# Set by MetricsMiddleware for the duration of a request. Threadpool calls
+# and AsyncSession.run_sync inherit the context, so the engine events below
+# see the same object.
+current_request: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "current_request", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_request.get()
+    if stats is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += elapsed
+
+
+def instrument_engine(engine):
+    # an AsyncEngine fires its events on the sync engine it wraps
+    engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+# ======================= MIDDLEWARE =========================
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = route_name(scope)
+            method = scope["method"]
+            request_seconds.observe(elapsed, method, route, status_code)
+            request_sql_statements.observe(stats.sql_statements, method, route)
+            request_sql_seconds.observe(stats.sql_seconds, method, route)
+
+
+def route_name(scope):
+    # FastAPI leaves the matched route in the scope; keeping the template
+    # instead of the raw path keeps the number of series bounded.
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope["path"].startswith("/static/"):
+        return "/static"
+    return "unmatched"
+
+
+# ======================= EXPOSITION =========================
+
+CACHES = {"user": user_cache, "token": token_cache, "page": page_cache}
+
+
+def expose_caches():
+    stats = {name: cache.stats() for name, cache in CACHES.items()}
+    for metric, key, kind, help in (
+        ("blog_cache_hits_total", "hits", "counter", "Cache lookups that found an entry."),
+        ("blog_cache_misses_total", "misses", "counter", "Cache lookups that missed."),
+        ("blog_cache_entries", "size", "gauge", "Entries currently held."),
+    ):
+        yield f"# HELP {metric} {help}"
+        yield f"# TYPE {metric} {kind}"
+        for name, values in stats.items():
+            # a shared cache can't count its entries cheaply
+            if values[key] is not None:
+                yield f'{metric}{{cache="{name}"}} {values[key]}'
+
+
+def expose_timings():
+    current = list(timings.items())
+    for metric, kind, help, value in (
+        ("blog_function_calls_total", "counter", "Calls of @timed functions.", lambda t: t.count),
+        ("blog_function_seconds_total", "counter", "Time spent in @timed functions.", lambda t: t.total),
+        ("blog_function_max_seconds", "gauge", "Slowest call of each @timed function.", lambda t: t.max),
+    ):
+        yield f"# HELP {metric} {help}"
+        yield f"# TYPE {metric} {kind}"
+        for name, timing in current:
+            yield f'{metric}{{function="{escape(name)}"}} {value(timing)}'
+
+
+def render():
+    lines = []
+    for family in (request_seconds, request_sql_statements, request_sql_seconds, template_seconds):
+        lines.extend(family.expose())
+    lines.extend(expose_caches())
+    lines.extend(expose_timings())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
@@ -0,0 +1,136 @@
+"""Idempotent schema upgrades for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, so anything added to
+a table that already exists in posts.db (indexes, columns) is applied here.
+Every step checks the live schema first and can be run any number of times:
+
+    python -m app.migrate
+
+Post comment counters can be rebuilt from the comments table at any time:
+
+    python -m app.migrate reconcile-counters
+
+and post bodies re-rendered after a change to app/rendering.py:
+
+    python -m app.migrate render-posts
+"""
+import datetime
+import logging
+import sys
+
+from sqlalchemy import bindparam, inspect, select, update
+from sqlalchemy.schema import CreateColumn
+
+from . import avatars, crud, models, rendering, search
+from .database import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(conn):
+    added = conn.info.setdefault("added_columns", set())
+    for table in models.Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+                added.add(f"{table.name}.{column.name}")
+                logger.info("added column %s.%s", table.name, column.name)
+
+
+def create_missing_indexes(conn):
+    for table in models.Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                logger.info("created index %s", index.name)
+
+
+def backfill_post_counters(conn):
+    # only needed once, right after the counter columns were added
+    if "blog_post.comment_count" in conn.info.get("added_columns", ()):
+        conn.execute(crud.post_counters_update())
+        logger.info("reconciled post comment counters")
+
+
+def render_stored_posts(conn, batch=500):
+    posts = models.BlogPost.__table__
+    last_id, rendered = 0, 0
+    while True:
+        rows = conn.execute(
+            select(posts.c.id, posts.c.body).where(posts.c.id > last_id).order_by(posts.c.id).limit(batch)
+        ).all()
+        if not rows:
+            return rendered
+        conn.execute(
+            update(posts).where(posts.c.id == bindparam("post_id")),
+            [{"post_id": row.id, **rendering.render_post(row.body)._asdict()} for row in rows],
+        )
+        last_id = rows[-1].id
+        rendered += len(rows)
+
+
+def backfill_rendered_posts(conn):
+    added = conn.info.get("added_columns", ())
+    if "blog_post.body_html" in added or "blog_post.body_text" in added:
+        logger.info("rendered %s post bodies", render_stored_posts(conn))
+
+
+def backfill_updated_at(conn):
+    # older posts only have their human-readable date, e.g. "May 3, 2022"
+    if "blog_post.updated_at" not in conn.info.get("added_columns", ()):
+        return
+    posts = models.BlogPost.__table__
+    rows = conn.execute(select(posts.c.id, posts.c.date)).all()
+    fallback = datetime.datetime.utcnow()
+    values = []
+    for row in rows:
+        try:
+            updated_at = datetime.datetime.strptime(row.date, "%B %d, %Y")
+        except (TypeError, ValueError):
+            updated_at = fallback
+        values.append({"post_id": row.id, "updated_at": updated_at})
+    if values:
+        conn.execute(update(posts).where(posts.c.id == bindparam("post_id")), values)
+    logger.info("filled updated_at of %s posts", len(values))
+
+
+STEPS = [
+    add_missing_columns,
+    create_missing_indexes,
+    search.install,
+    avatars.migrate_gravatar_urls,
+    backfill_post_counters,
+    backfill_rendered_posts,
+    backfill_updated_at,
+]
+
+
+def upgrade(bind=engine):
+    models.Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        for step in STEPS:
+            step(conn)
+        conn.info.pop("added_columns", None)
+
+
+def reconcile_counters():
+    with SessionLocal() as db:
+        print(f"reconciled {crud.reconcile_post_counters(db)} posts")
+
+
+def render_posts():
+    with engine.begin() as conn:
+        print(f"rendered {render_stored_posts(conn)} posts")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if sys.argv[1:] == ["reconcile-counters"]:
+        reconcile_counters()
+    elif sys.argv[1:] == ["render-posts"]:
+        render_posts()
+    else:
+        upgrade()
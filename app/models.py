@@ -1,20 +1,36 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, Text, DateTime
 
 from .database import Base
 
 
 class BlogPost(Base):
     __tablename__ = "blog_post"    
+    # title is already covered by the index behind its UNIQUE constraint
+    __table_args__ = (
+        Index("ix_blog_post_owner_id", "owner_id"),
+        Index("ix_blog_post_activity", "comment_count", "id"),
+        Index("ix_blog_post_last_comment_at", "last_comment_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String(250), unique=True, nullable=False)
     subtitle = Column(String(250), nullable=False)
     date = Column(String(250), nullable=False)
+    # machine-readable counterpart of date, moved forward by every edit
+    updated_at = Column(DateTime)
     body = Column(Text, nullable=False)
+    # rendered from body by rendering.render_post on every write
+    body_html = Column(Text, nullable=False, default="", server_default="")
+    body_text = Column(Text, nullable=False, default="", server_default="")
+    excerpt = Column(Text, nullable=False, default="", server_default="")
+    reading_time = Column(Integer, nullable=False, default=1, server_default="1")
     author = Column(String(250), nullable=False)
     img_url = Column(String(250), nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    # kept in step with the comments table by crud.add_comment/delete_post,
+    # crud.reconcile_post_counters rebuilds them from scratch
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_comment_at = Column(DateTime)
 
 
 class Users(Base):
@@ -28,10 +44,32 @@ class Users(Base):
     
 class Comment(Base):
     __tablename__ = "comments"
+    __table_args__ = (
+        Index("ix_comments_post_id_date", "post_id", "date"),
+    )
 
     id = Column(Integer, primary_key=True)
     text = Column(Text, nullable=False)
     date = Column(DateTime, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     post_id = Column(Integer, ForeignKey("blog_post.id"), nullable=False)
-    
\ No newline at end of file
+
+
+class Job(Base):
+    """A unit of follow-up work, see jobs.py."""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False, default="{}")
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_at = Column(DateTime, nullable=False)
+    locked_at = Column(DateTime)
+    created_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+    last_error = Column(Text)
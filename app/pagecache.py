@@ -0,0 +1,121 @@
+"""Rendered HTML for anonymous visitors, with ETag / Last-Modified validation.
+
+Pages are stored in cache.page_cache under "index:<query>" and
+"post:<id>:page" keys; the comment list of a post is kept as a fragment under
+"post:<id>:comments" so logged-in views can reuse it around their own header.
+feeds.py keeps its XML documents here too, under "feed:...".
+The crud write functions drop the affected keys (cache.invalidate_*).
+
+A page is built from a read that a concurrent write may invalidate before
+the page is stored, so the lookups return the generation of the key's group
+along with the entry, and a page built after a miss is stored under it:
+if the group was dropped in the meantime the page is not kept.
+"""
+import hashlib
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from typing import NamedTuple
+
+from fastapi import Request, Response
+from markupsafe import Markup
+
+from .cache import CURRENT, page_cache
+
+
+class CachedPage(NamedTuple):
+    body: bytes
+    etag: str
+    last_modified: float
+
+
+def index_key(request: Request):
+    return f"index:{request.url.query}"
+
+
+def post_key(post_id):
+    return f"post:{post_id}:page"
+
+
+def comments_key(post_id):
+    return f"post:{post_id}:comments"
+
+
+def make_page(body: bytes):
+    return CachedPage(
+        body=body,
+        etag='"' + hashlib.sha1(body).hexdigest() + '"',
+        last_modified=int(time.time()),
+    )
+
+
+def get_page(key):
+    return page_cache.get(key)
+
+
+def generation(key):
+    return page_cache.generation(key)
+
+
+def store_page(key, body: bytes, generation=CURRENT):
+    page = make_page(body)
+    page_cache.set(key, page, generation=generation)
+    return page
+
+
+# For the route handlers: with a shared cache these go through the threadpool
+# rather than block the event loop on Redis
+
+async def aget_page(key):
+    # (page or None, generation)
+    return await page_cache.alookup(key)
+
+
+async def astore_page(key, body: bytes, generation=CURRENT):
+    page = make_page(body)
+    await page_cache.aset(key, page, generation=generation)
+    return page
+
+
+def not_modified(request: Request, page: CachedPage):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return page.etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= page.last_modified
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def page_response(request: Request, page: CachedPage, media_type: str = "text/html"):
+    headers = {
+        "ETag": page.etag,
+        "Last-Modified": formatdate(page.last_modified, usegmt=True),
+        # shared caches may keep it, but must check back with us before reuse
+        "Cache-Control": "public, no-cache",
+        "Vary": "Cookie",
+    }
+    if not_modified(request, page):
+        return Response(status_code=304, headers=headers)
+    return Response(page.body, media_type=media_type, headers=headers)
+
+
+def store_streamed_page(key, chunks, generation=CURRENT):
+    # Pass a streamed page through and keep a copy once it has been sent in full
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    store_page(key, "".join(sent).encode("utf-8"), generation)
+
+
+async def aget_fragment(key):
+    fragment, generation = await page_cache.alookup(key)
+    return (Markup(fragment) if fragment is not None else None), generation
+
+
+async def astore_fragment(key, html: str, generation=CURRENT):
+    await page_cache.aset(key, str(html), generation=generation)
+    return Markup(html)
@@ -0,0 +1,156 @@
+"""Per-request SQL statement budgets, to catch N+1 queries early.
+
+Routes declare how many statements they are expected to need:
+
+    @app.get("/post/{index}")
+    @querybudget.budget(3)
+    async def show_post(...): ...
+
+Routes without a declaration get settings.query_budget_default. When a
+request executes more statements than its budget, a warning is logged with
+the call sites (in app/) of the statements past the limit, grouped so a
+query issued once per row stands out.
+
+In tests the same checks become failures, either per route through the
+`enforce_query_budgets` fixture in tests/conftest.py (built on enforcing(),
+see tests/test_query_budgets.py) or around any block of code:
+
+    with querybudget.assert_max_queries(2):
+        client.get("/")
+"""
+import contextvars
+import logging
+import os
+import sys
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+THIS_FILE = os.path.abspath(__file__)
+APP_DIR = os.path.dirname(THIS_FILE)
+
+
+def budget(max_queries: int | None):
+    # None turns the check off, for routes whose work grows with the input
+    def decorator(function):
+        function.query_budget = max_queries
+        return function
+    return decorator
+
+
+class Tracker:
+    def __init__(self, limit: int | None = None, scope=None):
+        self.limit = limit
+        self.scope = scope
+        self.count = 0
+        self.overruns: list[tuple[str, str]] = []
+
+    def budget(self):
+        # the router fills in scope["endpoint"] before the handler runs, so
+        # it is known by the time the first statement executes
+        if self.limit is None and self.scope is not None and "endpoint" in self.scope:
+            self.limit = getattr(self.scope["endpoint"], "query_budget", settings.query_budget_default)
+        return self.limit
+
+    def record(self, statement: str):
+        self.count += 1
+        limit = self.budget()
+        if limit is not None and self.count > limit:
+            self.overruns.append((call_site(), statement))
+
+    @property
+    def exceeded(self):
+        limit = self.budget()
+        return limit is not None and self.count > limit
+
+    def report(self):
+        lines = [f"{self.count} statements, budget {self.budget()}"]
+        for (site, statement), times in Counter(self.overruns).most_common():
+            lines.append(f"  {times}x at {site}: {' '.join(statement.split())[:120]}")
+        return "\n".join(lines)
+
+
+current_tracker: contextvars.ContextVar[Tracker | None] = contextvars.ContextVar(
+    "current_tracker", default=None)
+
+# Trackers opened by assert_max_queries; they see statements from every
+# thread, since a TestClient runs the app in a thread of its own
+global_trackers: list[Tracker] = []
+
+# Collects over-budget reports while enforce_query_budgets is active
+violations: list[str] | None = None
+
+
+def call_site():
+    # innermost frame in this package that isn't this module
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != THIS_FILE:
+            return f"{os.path.relpath(filename, os.path.dirname(APP_DIR))}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<outside app>"
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = current_tracker.get()
+    if tracker is not None:
+        tracker.record(statement)
+    for tracker in global_trackers:
+        tracker.record(statement)
+
+
+def instrument_engine(engine):
+    engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(engine, "after_cursor_execute", after_cursor_execute):
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        tracker = Tracker(scope=scope)
+        token = current_tracker.set(tracker)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_tracker.reset(token)
+            if tracker.exceeded:
+                message = f"query budget exceeded {scope['method']} {scope['path']}: {tracker.report()}"
+                logger.warning(message)
+                if violations is not None:
+                    violations.append(message)
+
+
+@contextmanager
+def assert_max_queries(max_queries: int):
+    tracker = Tracker(limit=max_queries)
+    global_trackers.append(tracker)
+    try:
+        yield tracker
+    finally:
+        global_trackers.remove(tracker)
+    if tracker.exceeded:
+        raise AssertionError(f"query budget exceeded: {tracker.report()}")
+
+
+@contextmanager
+def enforcing():
+    global violations
+    previous, violations = violations, []
+    try:
+        yield violations
+    finally:
+        collected, violations = violations, previous
+    if collected:
+        raise AssertionError("\n".join(collected))
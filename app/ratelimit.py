@@ -0,0 +1,282 @@
+"""Per-route rate limits, checked before a request reaches its handler.
+
+The routes worth protecting are the ones that cost something no matter
+who asks: /login, /token and /register run bcrypt, a comment is a write.
+RULES lists them with where the "user" of a request comes from; the
+numbers are in settings.rate_limits, one token bucket per rule and key:
+
+    "login.ip":   "30/minute"   any client address, 30 in a burst, then one every 2 s
+    "login.user": "10/minute"   per account named in the form
+
+A request that finds its bucket empty gets a 429 with Retry-After straight
+from the middleware, before the body is parsed by the route, before any
+session is opened and before any password is hashed. The account name is
+read from the form whether it is sent urlencoded or as multipart/form-data,
+like Form() accepts it.
+
+Each bucket is stored as a single number, the time at which it will be
+full again (GCRA, an equivalent form of the token bucket), so checking one
+is O(1) and a bucket that is full takes no space at all. MemoryStore keeps
+them per process; with cache_backend "redis" they live in Redis and are
+shared by all workers. The client address is scope["client"], so behind a
+proxy run uvicorn with --proxy-headers.
+"""
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.formparsers import FormParser, MultiPartException, MultiPartParser
+
+from . import security
+from .cache import shared_client
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+# forms are buffered up to this size to find the account name; larger ones
+# on a rule with a per-account limit are refused with a 413
+MAX_FORM_BYTES = 64 * 1024
+
+
+class Rule(NamedTuple):
+    name: str
+    method: str
+    path: re.Pattern
+    # form field naming the account; None means the logged-in user
+    user_field: str | None = None
+
+
+RULES = [
+    Rule("login", "POST", re.compile(r"^/login$"), user_field="email"),
+    Rule("token", "POST", re.compile(r"^/token$"), user_field="username"),
+    Rule("register", "POST", re.compile(r"^/register$"), user_field="name"),
+    Rule("comment", "POST", re.compile(r"^/post/\d+$")),
+]
+
+
+class Limit(NamedTuple):
+    interval: float  # seconds per token
+    burst: int
+
+
+def parse_limit(text: str) -> Limit:
+    count, _, period = text.partition("/")
+    count = int(count)
+    if count <= 0 or period.strip() not in PERIODS:
+        raise ValueError(f"bad rate limit {text!r}, expected e.g. '10/minute'")
+    return Limit(PERIODS[period.strip()] / count, count)
+
+
+class MemoryStore:
+    """Bucket states by key, least recently used first, at most maxsize of them."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, limit: Limit) -> float:
+        # returns 0 when allowed, else the seconds until it would be
+        now = time.monotonic()
+        with self._lock:
+            full_at = max(self._data.get(key, now), now) + limit.interval
+            allowed_at = full_at - limit.burst * limit.interval
+            if now < allowed_at:
+                return allowed_at - now
+            self._data[key] = full_at
+            self._data.move_to_end(key)
+            # buckets that have refilled are as good as absent; drop a few
+            # from the cold end while we're here
+            for _ in range(2):
+                oldest_key, oldest = next(iter(self._data.items()))
+                if oldest > now:
+                    break
+                del self._data[oldest_key]
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return 0
+
+    async def ahit(self, key: str, limit: Limit) -> float:
+        return self.hit(key, limit)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Same arithmetic as MemoryStore.hit in milliseconds, on the Redis clock so
+# workers on different hosts agree. The key expires when the bucket is full.
+HIT_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local full_at = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now) + interval
+local allowed_at = full_at - burst * interval
+if now < allowed_at then
+    return allowed_at - now
+end
+redis.call('SET', KEYS[1], full_at, 'PX', full_at - now)
+return 0
+"""
+
+
+class RedisStore:
+    def __init__(self, client, namespace: str = "blog"):
+        self.client = client
+        self.prefix = f"{namespace}:ratelimit:"
+        self.script = client.register_script(HIT_SCRIPT)
+
+    def hit(self, key: str, limit: Limit) -> float:
+        wait = self.script(keys=[self.prefix + key], args=[math.ceil(limit.interval * 1000), limit.burst])
+        return int(wait) / 1000
+
+    async def ahit(self, key: str, limit: Limit) -> float:
+        # a network round trip; not on the event loop
+        return await run_in_threadpool(self.hit, key, limit)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*", count=500))
+        if keys:
+            self.client.delete(*keys)
+
+
+def make_store():
+    # fakeredis runs no Lua, and lives in this process anyway
+    if shared_client is not None and settings.cache_backend == "redis":
+        return RedisStore(shared_client, settings.cache_namespace)
+    return MemoryStore(settings.rate_limit_max_keys)
+
+
+store = make_store()
+limits: dict[str, Limit] = {}
+
+
+def configure(rate_limits: dict[str, str]):
+    limits.clear()
+    limits.update({name: parse_limit(text) for name, text in rate_limits.items()})
+
+
+configure(settings.rate_limits)
+
+
+def match(method: str, path: str):
+    for rule in RULES:
+        if rule.method == method and rule.path.match(path):
+            return rule
+    return None
+
+
+def token_subject(scope):
+    # the same places security.oauth2_scheme looks, without touching the db
+    headers = dict(scope["headers"])
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if not authorization:
+        for part in headers.get(b"cookie", b"").decode("latin-1").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "access_token":
+                authorization = value.strip('"')
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return security.decode_access_token(token).get("sub")
+    except Exception:
+        return None
+
+
+async def read_form(scope, receive):
+    # Reads a form body, urlencoded or multipart like Form() accepts, so the
+    # account name can be found, and returns its text fields together with a
+    # receive() that hands the same body to the route. None means the body
+    # is over MAX_FORM_BYTES.
+    headers = Headers(scope=scope)
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        parser_class = FormParser
+    elif content_type.startswith("multipart/form-data"):
+        parser_class = MultiPartParser
+    else:
+        return {}, receive
+
+    messages, size, more = [], 0, True
+    while more and size <= MAX_FORM_BYTES:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        size += len(message.get("body", b""))
+        more = message.get("more_body", False)
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+
+    if more or size > MAX_FORM_BYTES:
+        return None, replay
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.request")
+
+    async def stream():
+        yield body
+
+    try:
+        form = await parser_class(headers, stream()).parse()
+    except MultiPartException:
+        # the route will turn it down too
+        return {}, replay
+    fields = {name: value for name, value in form.multi_items() if isinstance(value, str)}
+    await form.close()
+    return fields, replay
+
+
+class RateLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.rate_limit_enabled:
+            return await self.app(scope, receive, send)
+        rule = match(scope["method"], scope["path"])
+        if rule is None:
+            return await self.app(scope, receive, send)
+
+        keys = []
+        if f"{rule.name}.ip" in limits:
+            client = scope.get("client")
+            keys.append(("ip", client[0] if client else "unknown"))
+        if f"{rule.name}.user" in limits:
+            if rule.user_field is None:
+                user = token_subject(scope)
+            else:
+                form, receive = await read_form(scope, receive)
+                if form is None:
+                    # no account name to check, so no way past the per-user bucket
+                    return await respond(send, 413, b"Request body too large.\n")
+                user = form.get(rule.user_field, "").strip().lower() or None
+            if user is not None:
+                keys.append(("user", user))
+
+        for kind, value in keys:
+            wait = await store.ahit(f"{rule.name}.{kind}:{value}", limits[f"{rule.name}.{kind}"])
+            if wait:
+                logger.info("rate limited rule=%s.%s retry_after=%.1f", rule.name, kind, wait)
+                return await respond(send, 429, b"Too many requests, please try again later.\n",
+                                     [(b"retry-after", str(max(1, math.ceil(wait))).encode())])
+        await self.app(scope, receive, send)
+
+
+async def respond(send, status: int, body: bytes, headers=()):
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"text/plain; charset=utf-8"),
+        (b"content-length", str(len(body)).encode()),
+        *headers,
+    ]})
+    await send({"type": "http.response.body", "body": body})
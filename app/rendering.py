@@ -0,0 +1,141 @@
+"""Write-time rendering of post bodies.
+
+Bodies come from the CKEditor form as HTML. Instead of trusting that HTML on
+every view, crud.create_post/update_post run it through render_post() once
+and store the result next to the source:
+
+    body_html     the body reduced to an allowlist of tags and attributes
+    body_text     the whole body as plain text, for the search index
+    excerpt       the first words of it, for the front page
+    reading_time  whole minutes at READING_SPEED words per minute
+
+The source stays in BlogPost.body so the edit form shows what was typed.
+After changing the rules here, re-render the stored posts with
+
+    python -m app.migrate render-posts
+"""
+import html
+import re
+from html.parser import HTMLParser
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+ALLOWED_TAGS = {
+    "a", "abbr", "b", "blockquote", "br", "code", "del", "div", "em", "figcaption", "figure",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "i", "img", "li", "ol", "p", "pre", "s", "small",
+    "span", "strong", "sub", "sup", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "u", "ul",
+}
+VOID_TAGS = {"br", "hr", "img"}
+ALLOWED_ATTRIBUTES = {
+    "a": {"href", "title"},
+    "img": {"src", "alt", "title", "width", "height"},
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan"},
+}
+URL_ATTRIBUTES = {"href", "src"}
+ALLOWED_SCHEMES = {"", "http", "https", "mailto"}
+# dropped together with everything inside them
+DISCARD_TAGS = {"script", "style", "iframe", "object", "embed", "template", "noscript", "textarea", "select"}
+# text on either side of these shouldn't run together in the excerpt
+BLOCK_TAGS = {"p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "tr", "td", "th"}
+
+EXCERPT_WORDS = 40
+READING_SPEED = 200
+
+
+class RenderedPost(NamedTuple):
+    body_html: str
+    body_text: str
+    excerpt: str
+    reading_time: int
+
+
+class Sanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.output = []
+        self.text = []
+        self.open_tags = []
+        self.discarding = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DISCARD_TAGS:
+            self.discarding += 1
+            return
+        if self.discarding:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(" ")
+        if tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        rendered = "".join(
+            f' {name}="{html.escape(value, quote=True)}"'
+            for name, value in attrs
+            if name in allowed and value is not None and (name not in URL_ATTRIBUTES or safe_url(value))
+        )
+        if tag == "a" and "href" in rendered:
+            rendered += ' rel="nofollow noopener"'
+        self.output.append(f"<{tag}{rendered}>")
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in DISCARD_TAGS:
+            return
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.open_tags and self.open_tags[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DISCARD_TAGS:
+            self.discarding = max(0, self.discarding - 1)
+            return
+        if self.discarding:
+            return
+        if tag in BLOCK_TAGS:
+            self.text.append(" ")
+        if tag not in self.open_tags:
+            return
+        # close anything left open inside it, so the output stays balanced
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.output.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.discarding:
+            return
+        self.output.append(html.escape(data, quote=False))
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.output.append(f"</{self.open_tags.pop()}>")
+
+
+def safe_url(url: str):
+    # browsers ignore whitespace and control characters inside the scheme
+    cleaned = re.sub(r"[\x00-\x20]", "", url)
+    try:
+        return urlsplit(cleaned).scheme.lower() in ALLOWED_SCHEMES
+    except ValueError:
+        return False
+
+
+def render_post(body: str) -> RenderedPost:
+    parser = Sanitizer()
+    parser.feed(body or "")
+    parser.close()
+    words = "".join(parser.text).split()
+    excerpt = " ".join(words[:EXCERPT_WORDS])
+    if len(words) > EXCERPT_WORDS:
+        excerpt += "…"
+    return RenderedPost(
+        body_html="".join(parser.output),
+        body_text=" ".join(words),
+        excerpt=excerpt,
+        reading_time=max(1, round(len(words) / READING_SPEED)),
+    )
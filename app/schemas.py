@@ -58,6 +58,7 @@ class EntireComment(CommentText):
         orm_mode = True
 
 class AvatarComment(EntireComment):
+    id: int | None
     avatar_url: str | None
 
 
@@ -96,6 +97,16 @@ class User(UserBase):
         return self(name=name, email=email, password=password,)
     
 
+class CurrentUser(BaseModel):
+    id: int
+    name: str
+    email: str | None
+    avatar_url: str | None
+
+    class Config:
+        orm_mode = True
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -0,0 +1,173 @@
+"""Full-text search over posts and comments.
+
+On SQLite the text lives in an FTS5 table, search_index, kept in sync by
+triggers on blog_post and comments, so every write path (including bulk SQL)
+updates it in the same transaction. Posts are indexed from body_text, the
+plain text rendering.render_post() stores, so markup is never searchable. Rowids encode the source row: a post is
+stored at id * 2 and a comment at id * 2 + 1, which keeps trigger updates and
+deletes on the rowid index instead of scanning the table.
+
+On PostgreSQL the same search runs against to_tsvector() expressions backed
+by GIN indexes, so there is nothing to keep in sync.
+
+    python -m app.search rebuild
+"""
+import html
+import re
+import sys
+from typing import NamedTuple
+
+from markupsafe import Markup
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+SEARCH_PAGE_SIZE = 10
+
+SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        post_id UNINDEXED, title, subtitle, body, tokenize = 'porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS search_post_text_insert AFTER INSERT ON blog_post BEGIN
+        INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+        VALUES (new.id * 2, new.id, new.title, new.subtitle, new.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_post_text_update AFTER UPDATE OF title, subtitle, body_text ON blog_post BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+        VALUES (new.id * 2, new.id, new.title, new.subtitle, new.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_post_delete AFTER DELETE ON blog_post BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+        DELETE FROM search_index WHERE rowid IN (SELECT id * 2 + 1 FROM comments WHERE post_id = old.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_comment_insert AFTER INSERT ON comments BEGIN
+        INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+        VALUES (new.id * 2 + 1, new.post_id, '', '', new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_comment_update AFTER UPDATE OF text ON comments BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+        INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+        VALUES (new.id * 2 + 1, new.post_id, '', '', new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_comment_delete AFTER DELETE ON comments BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+# earlier versions indexed the raw body HTML
+SQLITE_LEGACY = ["search_post_insert", "search_post_update"]
+POSTGRES_LEGACY = ["ix_blog_post_search"]
+
+POSTGRES_SCHEMA = [
+    """CREATE INDEX IF NOT EXISTS ix_blog_post_text_search ON blog_post
+        USING GIN (to_tsvector('english', title || ' ' || subtitle || ' ' || body_text))""",
+    """CREATE INDEX IF NOT EXISTS ix_comments_search ON comments
+        USING GIN (to_tsvector('english', text))""",
+]
+
+# column weights for bm25(): post_id, title, subtitle, body
+SQLITE_SEARCH = text("""
+    SELECT search_index.rowid % 2 AS is_comment, search_index.post_id, blog_post.title,
+           snippet(search_index, 3, char(2), char(3), '…', 24) AS snippet
+    FROM search_index JOIN blog_post ON blog_post.id = search_index.post_id
+    WHERE search_index MATCH :query
+    ORDER BY bm25(search_index, 0.0, 10.0, 4.0, 1.0)
+    LIMIT :limit OFFSET :offset
+""")
+
+POSTGRES_SEARCH = text("""
+    WITH query AS (SELECT websearch_to_tsquery('english', :query) AS q)
+    SELECT is_comment, post_id, title,
+           ts_headline('english', document, q, 'StartSel=' || chr(2) || ', StopSel=' || chr(3) || ', MaxWords=24') AS snippet
+    FROM (
+        SELECT 0 AS is_comment, p.id AS post_id, p.title, p.body_text AS document, query.q,
+               ts_rank(to_tsvector('english', p.title || ' ' || p.subtitle || ' ' || p.body_text), query.q) AS rank
+        FROM blog_post p, query
+        WHERE to_tsvector('english', p.title || ' ' || p.subtitle || ' ' || p.body_text) @@ query.q
+        UNION ALL
+        SELECT 1, c.post_id, p.title, c.text, query.q, ts_rank(to_tsvector('english', c.text), query.q)
+        FROM comments c JOIN blog_post p ON p.id = c.post_id, query
+        WHERE to_tsvector('english', c.text) @@ query.q
+    ) AS hits
+    ORDER BY rank DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+
+class SearchResult(NamedTuple):
+    post_id: int
+    title: str
+    is_comment: bool
+    snippet: Markup
+
+
+def install(conn):
+    # Called from migrate.upgrade; a freshly created index is filled from the
+    # rows already in the database, and so is one built by the legacy triggers.
+    if conn.dialect.name == "sqlite":
+        existed = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'").first() is not None
+        legacy = conn.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)"
+            % ", ".join(f"'{name}'" for name in SQLITE_LEGACY)).scalar()
+        for name in SQLITE_LEGACY:
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+        for statement in SQLITE_SCHEMA:
+            conn.exec_driver_sql(statement)
+        if not existed or legacy:
+            rebuild(conn)
+    elif conn.dialect.name == "postgresql":
+        for name in POSTGRES_LEGACY:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        for statement in POSTGRES_SCHEMA:
+            conn.exec_driver_sql(statement)
+
+
+def rebuild(conn):
+    if conn.dialect.name != "sqlite":
+        return
+    conn.exec_driver_sql("DELETE FROM search_index")
+    conn.exec_driver_sql("""INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+                            SELECT id * 2, id, title, subtitle, body_text FROM blog_post""")
+    conn.exec_driver_sql("""INSERT INTO search_index(rowid, post_id, title, subtitle, body)
+                            SELECT id * 2 + 1, post_id, '', '', text FROM comments""")
+    conn.exec_driver_sql("INSERT INTO search_index(search_index) VALUES ('optimize')")
+
+
+def fts_query(query: str):
+    # Quote every word so user input can never be read as FTS5 syntax; the
+    # last word is a prefix so results show up while still typing.
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms) + "*"
+
+
+def highlight(snippet: str):
+    snippet = re.sub(r"<[^>]*>|^[^<]*?>|<[^>]*$", " ", snippet or "")
+    snippet = html.escape(html.unescape(snippet))
+    return Markup(snippet.replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
+
+def search(db: Session, query: str, page: int = 1, limit: int = SEARCH_PAGE_SIZE):
+    """Ranked results for one page, plus whether there is a next page."""
+    page = max(page, 1)
+    if db.bind.dialect.name == "sqlite":
+        statement, query = SQLITE_SEARCH, fts_query(query)
+    else:
+        statement, query = POSTGRES_SEARCH, query.strip()
+    if not query:
+        return [], False
+
+    rows = db.execute(statement, {"query": query, "limit": limit + 1, "offset": (page - 1) * limit}).all()
+    results = [SearchResult(row.post_id, row.title, bool(row.is_comment), highlight(row.snippet))
+               for row in rows[:limit]]
+    return results, len(rows) > limit
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m app.search rebuild")
+    from .database import engine
+    with engine.begin() as conn:
+        rebuild(conn)
+    print("search index rebuilt")
@@ -13,6 +13,15 @@ from datetime import datetime, timedelta
 from . import schemas, crud, database
 from sqlalchemy.orm import Session
 from fastapi.responses import  RedirectResponse
+from .config import settings
+from .cache import user_cache, token_cache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hmac
+import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 class OAuth2PasswordBearerWithCookie(OAuth2):
     def __init__(
@@ -31,7 +40,8 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
         authorization = request.headers.get("Authorization")
         if authorization == None:
             authorization: str = request.cookies.get("access_token")  #changed to accept access token from httpOnly Cookie
-        print("access_token is",authorization)
+        logger.debug("credentials source=%s present=%s",
+                     "header" if "Authorization" in request.headers else "cookie", authorization is not None)
 
         scheme, param = get_authorization_scheme_param(authorization)
         if not authorization or scheme.lower() != "bearer":
@@ -51,24 +61,54 @@ SECRET_KEY = "b02a28fa93c2e6f49b7060483aae1a55050db8e7fea1b53c4efe4ea999e89bd8"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds)
+
+# bcrypt is slow on purpose, so it gets its own small pool: a burst of logins
+# queues up here instead of blocking the event loop or the default threadpool.
+password_executor = ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
+pending_password_jobs = 0
 
 oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="token", auto_error=False)
 
 
+async def run_password_job(function, *args):
+    global pending_password_jobs
+    if pending_password_jobs >= settings.password_hash_max_pending:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress. Please try again.",
+            headers={"Retry-After": "1"},
+        )
+    pending_password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, function, *args)
+    finally:
+        pending_password_jobs -= 1
+
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
-def authenticate_user(username: str, password: str, db):
+async def verify_password_async(plain_password, hashed_password):
+    # returns (valid, new_hash); new_hash is set when the stored hash uses
+    # outdated settings and should be replaced
+    return await run_password_job(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def authenticate_user(username: str, password: str, db):
     try:
-        user = crud.get_user_by_name(db, username)
+        user = await database.run_db(db, crud.get_user_by_name, username)
     except:
         user = None
     if not user:
         return False
-    if not verify_password(password, user.password):
+    valid, new_hash = await verify_password_async(password, user.password)
+    if not valid:
         return False
+    if new_hash:
+        await database.run_db(db, crud.update_user_password, user, new_hash)
     return user
 
 
@@ -76,6 +116,10 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def get_password_hash_async(password):
+    return await run_password_job(pwd_context.hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -87,6 +131,27 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     return encoded_jwt
 
 
+def decode_access_token(token: str):
+    # Verifying the signature on every request is wasted work for a token we
+    # have already accepted, so payloads are remembered until they expire.
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.set(token, payload, ttl=payload.get("exp", 0) - time.time())
+    return payload
+
+
+async def load_current_user(db, username: str):
+    user = await user_cache.aget(username)
+    if user is None:
+        db_user = await database.run_db(db, crud.get_user_by_name, username=username)
+        if db_user is None:
+            return None
+        user = schemas.CurrentUser.from_orm(db_user)
+        await user_cache.aset(username, user)
+    return user
+
+
 async def get_current_user(db:Session = Depends(database.get_db), token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -94,10 +159,10 @@ async def get_current_user(db:Session = Depends(database.get_db), token: str = D
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
-            print ("credentials_exception: User name is None")
+            logger.debug("rejecting token without a subject")
             raise credentials_exception
         
         token_data = schemas.TokenData(username=username)
@@ -107,7 +172,7 @@ async def get_current_user(db:Session = Depends(database.get_db), token: str = D
         return token
 
     except JWTError:
-        print ("credentials_exception: something worng with jwt.decode function")
+        logger.info("rejecting token that failed to decode")
         raise credentials_exception
     
     except:
@@ -115,9 +180,9 @@ async def get_current_user(db:Session = Depends(database.get_db), token: str = D
         # or database errors - either way we ignore them and return None
         return None
     
-    user = crud.get_user_by_name(db, username=token_data.username)
+    user = await load_current_user(db, token_data.username)
     if user is None:
-        print ("credentials_exception: user doesnt exist")
+        logger.debug("rejecting token for unknown user=%r", token_data.username)
         raise credentials_exception
     return user
 
@@ -130,6 +195,14 @@ def get_current_user_required(user: Union[schemas.User, None] = Depends(get_curr
         )
     return user
 
+def require_bulk_token(request: Request):
+    expected = settings.bulk_api_token
+    if not expected:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    given = request.headers.get("X-Bulk-Token", "")
+    if not hmac.compare_digest(given.encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid bulk token")
+
 from functools import wraps
 
 # Under work
@@ -153,11 +226,13 @@ def expired_redirection(original_function):
 
 def owner_privilages(original_function):
     @wraps(original_function)
-    def wrapper_function(**kwargs):
-        data = crud.get_post(kwargs["db"], kwargs["id"])
-        print(data)
+    async def wrapper_function(**kwargs):
+        data = await database.run_db(kwargs["db"], crud.get_post, kwargs["id"])
+        logger.debug("owner check post_id=%s found=%s", kwargs["id"], data is not None)
+        if data is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
         if kwargs["current_user"].id == data.owner_id:
-            return original_function(**kwargs)
+            return await original_function(**kwargs)
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
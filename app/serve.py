@@ -0,0 +1,78 @@
+"""Production entry point: gunicorn with one uvicorn worker per CPU core.
+
+    BLOG_CACHE_BACKEND=redis BLOG_TEMPLATES_PRODUCTION=1 python -m app.serve
+
+app.main is imported once in the master before forking (preload), so the
+schema upgrade runs a single time and the workers start with the code
+already imported. Each worker then throws away the database connections it
+inherited and opens its own. Without gunicorn (it doesn't run on Windows)
+this falls back to `uvicorn --workers`, which imports the app in every
+worker instead.
+
+Sessions and CSRF tokens live in signed cookies, so any worker can serve
+any request. The user and page caches only stay coherent across workers
+with the redis cache backend, since create_post/update_post invalidate
+them in the worker that handled the write.
+"""
+import logging
+import os
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def worker_count():
+    return settings.web_workers or os.cpu_count() or 1
+
+
+def post_fork(server, worker):
+    # pooled connections opened in the master must not be shared
+    from . import database
+    database.engine.dispose(close=False)
+    if database.async_engine is not None:
+        database.async_engine.sync_engine.dispose(close=False)
+
+
+def run_gunicorn(workers):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", settings.bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("graceful_timeout", settings.graceful_timeout)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            from .main import app
+            return app
+
+    Server().run()
+
+
+def run_uvicorn(workers):
+    import uvicorn
+    host, _, port = settings.bind.rpartition(":")
+    uvicorn.run("app.main:app", host=host or "127.0.0.1", port=int(port), workers=workers,
+                timeout_graceful_shutdown=settings.graceful_timeout)
+
+
+def main():
+    logging.basicConfig(level=settings.log_level.upper(), format=settings.log_format)
+    workers = worker_count()
+    if workers > 1 and settings.cache_backend != "redis":
+        logger.warning("%s workers with the %s cache backend: a write only clears the "
+                       "caches of the worker that made it", workers, settings.cache_backend)
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        run_uvicorn(workers)
+    else:
+        run_gunicorn(workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""The Jinja2 environment used by every handler.
+
+In production mode (settings.templates_production) templates are compiled
+once into a persistent bytecode cache, the per-render mtime checks are turned
+off and warm_up() renders each page before the worker takes traffic.
+"""
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, Template
+from starlette.requests import Request
+
+from . import assets, metrics
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TimedTemplate(Template):
+    # Reports render time to metrics.template_seconds. For generate() only
+    # the time spent producing chunks counts, not the time the consumer
+    # takes between them.
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            metrics.template_seconds.observe(time.perf_counter() - start, self.name)
+
+    def generate(self, *args, **kwargs):
+        elapsed = 0.0
+        chunks = super().generate(*args, **kwargs)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield chunk
+        finally:
+            metrics.template_seconds.observe(elapsed, self.name)
+
+
+templates = Jinja2Templates(directory="templates")
+templates.env.template_class = TimedTemplate
+templates.env.globals.update(static_url=assets.static_url, background_style=assets.background_style)
+
+if settings.templates_production:
+    templates.env.auto_reload = False
+    os.makedirs(settings.template_cache_dir, exist_ok=True)
+    templates.env.bytecode_cache = FileSystemBytecodeCache(settings.template_cache_dir)
+
+
+def stream(name: str, context: dict, flush_size: int = 4096):
+    # Template.generate() yields many tiny strings; send them in blocks
+    buffer, size = [], 0
+    for chunk in templates.get_template(name).generate(context):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= flush_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+SAMPLE_POST = SimpleNamespace(id=0, title="", subtitle="", author="", date="", body="", img_url="",
+                              body_html="", body_text="", excerpt="", reading_time=1,
+                              comment_count=0, last_comment_at=None)
+
+# Enough context for the pages that expect data to render all their branches
+WARM_UP_CONTEXTS = {
+    "index.html": {"all_posts": [SAMPLE_POST], "next_before": None, "limit": 10},
+    "post.html": {"requested_post": SAMPLE_POST, "comments_html": ""},
+    "comments.html": {"comments": []},
+    "search.html": {"q": "", "page": 1, "results": [], "has_next": False},
+    "login.html": {"user": "", "msg": ""},
+    "register.html": {"user": "", "msg": ""},
+}
+
+
+def precompile():
+    names = templates.env.list_templates(extensions=["html"])
+    for name in names:
+        templates.env.get_template(name)
+    return names
+
+
+def warm_up(app):
+    request = Request({
+        "type": "http", "app": app, "router": app.router, "method": "GET", "path": "/",
+        "root_path": "", "scheme": "http", "server": ("localhost", 80), "headers": [], "query_string": b"",
+    })
+    for name in precompile():
+        context = {"request": request, "logged_in": None, **WARM_UP_CONTEXTS.get(name, {})}
+        try:
+            templates.get_template(name).render(context)
+        except Exception as error:
+            # pages built around a form object only get compiled
+            logger.debug("warm-up render of %s skipped: %s", name, error)
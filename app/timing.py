@@ -0,0 +1,42 @@
+import logging
+import time
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        average = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "avg_ms": average * 1000, "max_ms": self.max * 1000}
+
+
+# Collected per decorated function name
+timings: dict[str, Timing] = {}
+
+
+def timed(name: str):
+    def decorator(function):
+        timing = timings.setdefault(name, Timing())
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                timing.add(elapsed)
+                logger.debug("%s took %.2f ms", name, elapsed * 1000)
+        return wrapper
+    return decorator
@@ -0,0 +1,72 @@
+"""Import-to-first-byte for app.main, in development and production template modes.
+
+Each run is a fresh interpreter that imports app.main, runs the startup
+handlers and serves GET / and GET /about in-process, timing each stage.
+Production mode is measured twice: with an empty bytecode cache (first
+deploy) and with the cache left by the previous run (every restart after):
+
+    python -m benchmarks.cold_start --runs 5
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app.main.app) as client:
+    started = time.perf_counter()
+    client.get("/")
+    first = time.perf_counter()
+    client.get("/about")
+    second = time.perf_counter()
+print(json.dumps({"import": imported - start, "startup": started - imported,
+                  "first request": first - started, "second page": second - first,
+                  "total": first - start}))
+"""
+
+
+def measure(environment, runs, clear_cache=None):
+    samples = []
+    for _ in range(runs):
+        if clear_cache:
+            shutil.rmtree(clear_cache, ignore_errors=True)
+        output = subprocess.run([sys.executable, "-c", PROBE], env=environment, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {stage: statistics.median(sample[stage] for sample in samples) for stage in samples[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = dict(os.environ, BLOG_DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                    PYTHONPATH=os.getcwd())
+        cache_dir = os.path.join(tmp, "template_cache")
+        production = dict(base, BLOG_TEMPLATES_PRODUCTION="1", BLOG_TEMPLATE_CACHE_DIR=cache_dir)
+        modes = [
+            ("development", base, None),
+            ("production, empty cache", production, cache_dir),
+            ("production, warm cache", production, None),
+        ]
+        measure(base, 1)
+        for name, environment, clear_cache in modes:
+            result = measure(environment, args.runs, clear_cache)
+            print(f"{name}:")
+            for stage, seconds in result.items():
+                print(f"  {stage:14} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
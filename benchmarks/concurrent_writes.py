@@ -0,0 +1,122 @@
+"""Concurrent comment writers and post readers against a local SQLite file.
+
+Runs the same workload through a bare engine (rollback journal, no busy
+timeout) and through `database.build_engine` (WAL, busy_timeout, mmap) and
+reports throughput, lock errors and latency percentiles for each:
+
+    python -m benchmarks.concurrent_writes --writers 8 --readers 8 --seconds 5
+"""
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, database, models, schemas
+
+
+def seed(engine, posts=50):
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        db.add(models.Users(id=1, email="bench@example.com", name="bench", password=""))
+        db.add_all(models.BlogPost(id=i, title=f"Post {i}", subtitle="subtitle", date="January 1, 2023",
+                                   body="body " * 200, author="bench", img_url="http://example.com/a.jpg",
+                                   owner_id=1)
+                   for i in range(1, posts + 1))
+        db.commit()
+    return posts
+
+
+def run(engine, writers, readers, seconds):
+    posts = seed(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    stop = time.perf_counter() + seconds
+    results = {"write": [], "read": [], "errors": 0}
+    lock = threading.Lock()
+
+    def writer():
+        with Session() as db:
+            i = 0
+            while time.perf_counter() < stop:
+                i += 1
+                comment = schemas.EntireComment(text="bench", date=datetime.datetime.now(),
+                                                owner_id=1, post_id=i % posts + 1)
+                start = time.perf_counter()
+                try:
+                    crud.add_comment(db, comment)
+                except OperationalError:
+                    db.rollback()
+                    with lock:
+                        results["errors"] += 1
+                    continue
+                with lock:
+                    results["write"].append(time.perf_counter() - start)
+
+    def reader():
+        with Session() as db:
+            i = 0
+            while time.perf_counter() < stop:
+                i += 1
+                start = time.perf_counter()
+                try:
+                    # what GET /post/{n} reads: the post and its first comments
+                    crud.get_post(db, i % posts + 1)
+                    crud.get_comments_page(db, i % posts + 1)
+                    db.rollback()
+                except OperationalError:
+                    db.rollback()
+                    with lock:
+                        results["errors"] += 1
+                    continue
+                with lock:
+                    results["read"].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summary(name, samples, seconds):
+    if not samples:
+        return f"  {name}: no successful operations"
+    quantiles = statistics.quantiles(samples, n=100)
+    return (f"  {name}: {len(samples) / seconds:8.1f} ops/s  "
+            f"p50 {quantiles[49] * 1000:7.2f} ms  p95 {quantiles[94] * 1000:7.2f} ms  "
+            f"p99 {quantiles[98] * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engines = {
+            "bare engine": lambda url: create_engine(url, connect_args={"check_same_thread": False, "timeout": 0}),
+            "build_engine": database.build_engine,
+        }
+        for name, factory in engines.items():
+            url = f"sqlite:///{os.path.join(tmp, name.replace(' ', '_'))}.db"
+            engine = factory(url)
+            results = run(engine, args.writers, args.readers, args.seconds)
+            engine.dispose()
+            print(f"{name}: {results['errors']} lock errors")
+            print(summary("comment writes", results["write"], args.seconds))
+            print(summary("post reads", results["read"], args.seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Fill a SQLite database with synthetic users, posts and comments.
+
+The schema, search index and triggers come from `app.migrate`, rows go in
+through the `models` tables in batches, and the per-post comment counters
+are reconciled at the end, so the result looks like a long-running blog.
+Every user is `user{n}` / `user{n}@example.com` with the password `secret`.
+Post bodies are a few paragraphs long with a log-normal word count (median
+around --body-words), comments are spread over the last year:
+
+    python -m benchmarks.datagen bench.db --users 200 --posts 5000 --comments 50000
+
+The same --seed always produces the same database.
+"""
+import argparse
+import datetime
+import os
+import random
+import time
+
+from app import avatars, crud, database, migrate, models, rendering, security
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+         "exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute irure "
+         "in reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint "
+         "occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est "
+         "python fastapi sqlite cache index query latency request template cursor").split()
+
+PASSWORD = "secret"
+
+
+def words(rng, count):
+    return " ".join(rng.choices(WORDS, k=count))
+
+
+def body(rng, median_words):
+    total = max(20, int(rng.lognormvariate(0, 0.6) * median_words))
+    paragraphs = []
+    while total > 0:
+        size = min(total, rng.randint(40, 120))
+        paragraphs.append(f"<p>{words(rng, size).capitalize()}.</p>")
+        total -= size
+    return "\n".join(paragraphs)
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(engine, users, posts, comments, body_words=600, seed=1, batch=2000):
+    rng = random.Random(seed)
+    # one hash for everybody, at the configured cost so logins don't rehash
+    password = security.get_password_hash(PASSWORD)
+    now = datetime.datetime(2024, 1, 1)
+
+    def user_rows():
+        for i in range(1, users + 1):
+            email = f"user{i}@example.com"
+            yield {"id": i, "name": f"user{i}", "email": email, "password": password,
+                   "avatar_url": avatars.avatar_url(email)}
+
+    def post_rows():
+        for i in range(1, posts + 1):
+            day = now - datetime.timedelta(days=posts - i)
+            text = body(rng, body_words)
+            yield {"id": i, "title": f"{words(rng, 5).capitalize()} #{i}", "subtitle": words(rng, 10),
+                   "date": f"{day.strftime('%B')} {day.day}, {day.year}", "updated_at": day, "body": text,
+                   "author": f"user{(i % users) + 1}", "img_url": "https://example.com/header.jpg",
+                   "owner_id": (i % users) + 1, **rendering.render_post(text)._asdict()}
+
+    def comment_rows():
+        # a few posts get most of the discussion
+        weights = [1 / (rank + 1) for rank in range(posts)]
+        targets = rng.choices(range(1, posts + 1), weights=weights, k=comments)
+        for target in targets:
+            yield {"text": words(rng, rng.randint(5, 60)).capitalize(),
+                   "date": now - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                   "owner_id": rng.randint(1, users), "post_id": target}
+
+    counts = {}
+    for table, rows in ((models.Users.__table__, user_rows()),
+                        (models.BlogPost.__table__, post_rows()),
+                        (models.Comment.__table__, comment_rows())):
+        counts[table.name] = 0
+        for chunk in batches(rows, batch):
+            with engine.begin() as conn:
+                conn.execute(table.insert(), chunk)
+            counts[table.name] += len(chunk)
+
+    with engine.begin() as conn:
+        conn.execute(crud.post_counters_update())
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="SQLite file to create")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=10000)
+    parser.add_argument("--body-words", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="overwrite an existing file")
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        if not args.force:
+            parser.error(f"{args.path} exists, pass --force to replace it")
+        os.remove(args.path)
+
+    engine = database.build_engine(f"sqlite:///{os.path.abspath(args.path)}")
+    migrate.upgrade(engine)
+    start = time.perf_counter()
+    counts = generate(engine, args.users, args.posts, args.comments, args.body_words, args.seed)
+    elapsed = time.perf_counter() - start
+    print(", ".join(f"{count} {table}" for table, count in counts.items()) + f" in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
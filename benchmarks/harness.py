@@ -0,0 +1,219 @@
+"""Latency percentiles and throughput for the main flows, saved as JSON.
+
+Runs the app in-process (httpx over ASGI, no network) against a copy of a
+database made by `benchmarks.datagen`, so writes never touch the original.
+Each scenario gets a short warm-up, then --requests requests spread over
+--concurrency clients:
+
+    index     GET /                       anonymous, served from the page cache
+    post      GET /post/{n}               random post, logged in (no page cache)
+    login     POST /login                 bcrypt verify + token
+    comment   POST /post/{n}              logged in, random post
+    new_post  GET + POST /new_post/       the whole form round trip, CSRF included
+
+    python -m benchmarks.datagen bench.db
+    python -m benchmarks.harness bench.db --out benchmarks/results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.harness bench.db --baseline benchmarks/results/<older>.json
+
+With --baseline the new numbers are printed next to the old ones. For a
+real server over the network see benchmarks/locustfile.py.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ["index", "post", "login", "comment", "new_post"]
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Scenario:
+    def __init__(self, client, anonymous, posts, users, rng):
+        self.client = client
+        self.anonymous = anonymous
+        self.posts = posts
+        self.users = users
+        self.rng = rng
+        self.counter = 0
+
+    async def index(self):
+        return await self.anonymous.get("/")
+
+    async def post(self):
+        return await self.client.get(f"/post/{self.rng.randint(1, self.posts)}")
+
+    async def login(self):
+        name = f"user{self.rng.randint(1, self.users)}"
+        return await self.client.post("/login", data={"email": name, "password": "secret"})
+
+    async def comment(self):
+        return await self.client.post(f"/post/{self.rng.randint(1, self.posts)}",
+                                      data={"text": "benchmark comment"},
+                                      headers={"X-Requested-With": "fetch"})
+
+    async def new_post(self):
+        form = await self.client.get("/new_post/")
+        self.counter += 1
+        return await self.client.post("/new_post/", data={
+            "csrf_token": CSRF.search(form.text).group(1),
+            "title": f"benchmark {os.getpid()} {id(self)} {self.counter}",
+            "subtitle": "benchmark", "author": "benchmark",
+            "img_url": "https://example.com/header.jpg", "body": "<p>benchmark</p>",
+        })
+
+
+async def log_in(client, user):
+    response = await client.post("/login", data={"email": user, "password": "secret"})
+    # the cookie is only flagged secure; the ASGI client talks plain http
+    token = response.cookies.get("access_token") or re.search(
+        r'access_token="?([^";]+)', response.headers["set-cookie"]).group(1)
+    client.cookies.set("access_token", token)
+
+
+async def run_scenario(name, clients, requests, warmup):
+    async def worker(scenario, count, samples, statuses):
+        action = getattr(scenario, name)
+        for _ in range(count):
+            start = time.perf_counter()
+            response = await action()
+            samples.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    await asyncio.gather(*(worker(scenario, warmup, [], {}) for scenario in clients))
+
+    samples, statuses = [], {}
+    per_client, extra = divmod(requests, len(clients))
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        worker(scenario, per_client + (i < extra), samples, statuses)
+        for i, scenario in enumerate(clients)
+    ))
+    elapsed = time.perf_counter() - start
+    return summarize(samples, statuses, elapsed)
+
+
+def summarize(samples, statuses, elapsed):
+    quantiles = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+    return {
+        "requests": len(samples),
+        "throughput_rps": len(samples) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "max_ms": max(samples) * 1000,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+async def run(args, counts):
+    import httpx
+    from app.main import app
+
+    results = {}
+    clients = []
+    for i in range(args.concurrency):
+        client = httpx.AsyncClient(app=app, base_url="http://bench", follow_redirects=False)
+        anonymous = httpx.AsyncClient(app=app, base_url="http://bench", follow_redirects=False)
+        await log_in(client, f"user{i % counts['users'] + 1}")
+        clients.append(Scenario(client, anonymous, counts["posts"], counts["users"], random.Random(args.seed + i)))
+    try:
+        for name in args.scenarios:
+            results[name] = await run_scenario(name, clients, args.requests, args.warmup)
+            print(format_row(name, results[name]))
+    finally:
+        for scenario in clients:
+            await scenario.client.aclose()
+            await scenario.anonymous.aclose()
+    return results
+
+
+def format_row(name, result, baseline=None):
+    row = (f"{name:9} {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:8.2f}  "
+           f"p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms  {result['statuses']}")
+    if baseline:
+        row += (f"\n{'':9} was {baseline['throughput_rps']:8.1f} req/s  p50 {baseline['p50_ms']:8.2f}  "
+                f"p95 {baseline['p95_ms']:8.2f}  p99 {baseline['p99_ms']:8.2f} ms  "
+                f"(p95 {change(result['p95_ms'], baseline['p95_ms'])}, "
+                f"throughput {change(result['throughput_rps'], baseline['throughput_rps'])})")
+    return row
+
+
+def change(new, old):
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def count_rows(path):
+    import sqlite3
+    with sqlite3.connect(path) as conn:
+        return {"users": conn.execute("SELECT max(id) FROM users").fetchone()[0],
+                "posts": conn.execute("SELECT max(id) FROM blog_post").fetchone()[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", help="SQLite file made by benchmarks.datagen")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per client first")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    counts = count_rows(args.database)
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "bench.db")
+        shutil.copyfile(args.database, copy)
+        os.environ["BLOG_DATABASE_URL"] = f"sqlite:///{copy}"
+        os.environ.setdefault("BLOG_LOG_LEVEL", "WARNING")
+        os.environ.setdefault("BLOG_PASSWORD_HASH_MAX_PENDING", str(args.concurrency * 2))
+        # every client comes from one address; measure the app, not the limiter
+        os.environ.setdefault("BLOG_RATE_LIMIT_ENABLED", "false")
+        sys.path.insert(0, os.getcwd())
+        results = asyncio.run(run(args, counts))
+
+    report = {
+        "revision": revision(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": {"path": args.database, **counts},
+        "options": {"requests": args.requests, "warmup": args.warmup,
+                    "concurrency": args.concurrency, "seed": args.seed},
+        "scenarios": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {baseline.get('revision')} ({baseline.get('date')})")
+        if baseline.get("options") != report["options"] or baseline.get("database") != report["database"]:
+            print("note: the baseline was run with different options or data")
+        for name, result in results.items():
+            print(format_row(name, result, baseline["scenarios"].get(name)))
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
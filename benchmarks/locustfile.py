@@ -0,0 +1,76 @@
+"""The harness scenarios as a locust load test against a running server.
+
+Needs `pip install locust` and a server whose database came from
+`benchmarks.datagen` (users user1..userN, password "secret"):
+
+    BLOG_DATABASE_URL=sqlite:///bench.db BLOG_RATE_LIMIT_ENABLED=false uvicorn app.main:app --workers 4
+    locust -f benchmarks/locustfile.py --host http://localhost:8000 \\
+        --users 50 --spawn-rate 10 --run-time 1m --headless --json > results.json
+
+BENCH_USERS and BENCH_POSTS must match the generated data (defaults 100
+and 1000, as in datagen).
+"""
+import os
+import random
+import re
+
+from locust import HttpUser, between, task
+
+USERS = int(os.environ.get("BENCH_USERS", 100))
+POSTS = int(os.environ.get("BENCH_POSTS", 1000))
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Reader(HttpUser):
+    """Anonymous visitors, mostly served from the page cache."""
+    weight = 3
+    wait_time = between(0.5, 2)
+
+    @task(3)
+    def index(self):
+        self.client.get("/", name="/")
+
+    @task(5)
+    def post(self):
+        self.client.get(f"/post/{random.randint(1, POSTS)}", name="/post/{index}")
+
+
+class Writer(HttpUser):
+    """Logged-in users reading, commenting and now and then posting."""
+    weight = 1
+    wait_time = between(1, 3)
+
+    def on_start(self):
+        self.name = f"user{random.randint(1, USERS)}"
+        self.login()
+
+    @task(1)
+    def login(self):
+        response = self.client.post("/login", data={"email": self.name, "password": "secret"},
+                                    allow_redirects=False, name="/login")
+        # the token cookie is flagged secure, so carry it by hand over plain http
+        token = response.cookies.get("access_token")
+        if token:
+            self.client.cookies.set("access_token", token)
+
+    @task(5)
+    def post(self):
+        self.client.get(f"/post/{random.randint(1, POSTS)}", name="/post/{index} (logged in)")
+
+    @task(3)
+    def comment(self):
+        self.client.post(f"/post/{random.randint(1, POSTS)}", data={"text": "load test comment"},
+                         headers={"X-Requested-With": "fetch"}, name="/post/{index} comment")
+
+    @task(1)
+    def new_post(self):
+        form = self.client.get("/new_post/", name="/new_post/ form")
+        match = CSRF.search(form.text)
+        if match is None:
+            return
+        self.client.post("/new_post/", allow_redirects=False, name="/new_post/", data={
+            "csrf_token": match.group(1),
+            "title": f"load test {self.name} {random.getrandbits(48)}",
+            "subtitle": "load test", "author": self.name,
+            "img_url": "https://example.com/header.jpg", "body": "<p>load test</p>",
+        })
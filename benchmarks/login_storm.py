@@ -0,0 +1,91 @@
+"""Page latency while a burst of logins is being verified.
+
+Starts the app in-process against a throwaway SQLite file, fires concurrent
+POST /login requests and meanwhile keeps requesting /about, reporting the
+page latency percentiles with and without the login storm. --inline runs
+bcrypt on the event loop, as the handlers did before the hashing pool:
+
+    python -m benchmarks.login_storm --logins 40
+    python -m benchmarks.login_storm --logins 40 --inline
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+async def probe(client, stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get("/about")
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(0.005)
+
+
+def summary(name, samples):
+    quantiles = statistics.quantiles(samples, n=100)
+    return (f"{name}: {len(samples)} requests  p50 {quantiles[49] * 1000:7.2f} ms  "
+            f"p95 {quantiles[94] * 1000:7.2f} ms  max {max(samples) * 1000:7.2f} ms")
+
+
+async def run(args):
+    import httpx
+    from app import security
+    from app.main import app
+
+    if args.inline:
+        async def run_password_job(function, *args):
+            return function(*args)
+        security.run_password_job = run_password_job
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        await client.post("/register", data={"name": "storm", "email": "storm@example.com", "password": "secret"})
+
+        stop = asyncio.Event()
+        idle = []
+        task = asyncio.create_task(probe(client, stop, idle))
+        await asyncio.sleep(args.seconds)
+        stop.set()
+        await task
+
+        stop = asyncio.Event()
+        storm = []
+        task = asyncio.create_task(probe(client, stop, storm))
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(
+            client.post("/login", data={"email": "storm", "password": "secret"})
+            for _ in range(args.logins)
+        ))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await task
+
+    statuses = {}
+    for response in responses:
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    print(f"{args.logins} logins in {elapsed:.2f} s, statuses {statuses}")
+    print(summary("idle   /about", idle))
+    print(summary("storm  /about", storm))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--seconds", type=float, default=1)
+    parser.add_argument("--inline", action="store_true", help="verify passwords on the event loop")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["BLOG_DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.setdefault("BLOG_PASSWORD_HASH_MAX_PENDING", str(args.logins))
+        # one client logging in over and over; measure bcrypt, not the limiter
+        os.environ.setdefault("BLOG_RATE_LIMIT_ENABLED", "false")
+        sys.path.insert(0, os.getcwd())
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Query plans and timings for the hot lookups, before and after `app.migrate`.
+
+Builds a throwaway SQLite database with the pre-index schema, fills it with
+synthetic rows, then runs the queries behind show_post, owner_privilages and
+get_post_by_title before and after applying the migration:
+
+    python -m benchmarks.query_plans --posts 5000 --comments 200000
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+from app import migrate, models
+
+
+QUERIES = {
+    "comments of a post by date": (
+        "SELECT * FROM comments WHERE post_id = :post_id ORDER BY date",
+        lambda n: {"post_id": random.randint(1, n)},
+    ),
+    "posts of an owner": (
+        "SELECT id FROM blog_post WHERE owner_id = :owner_id",
+        lambda n: {"owner_id": random.randint(1, 50)},
+    ),
+    "post by title": (
+        "SELECT id FROM blog_post WHERE title = :title",
+        lambda n: {"title": f"Post {random.randint(1, n)}"},
+    ),
+}
+
+
+def fill(engine, posts, comments):
+    now = datetime.datetime(2023, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(models.Users.__table__.insert(), [
+            {"id": i, "email": f"user{i}@example.com", "name": f"user{i}", "password": "", "avatar_url": ""}
+            for i in range(1, 51)
+        ])
+        conn.execute(models.BlogPost.__table__.insert(), [
+            {"id": i, "title": f"Post {i}", "subtitle": "subtitle", "date": "January 1, 2023",
+             "body": "body " * 50, "author": "author", "img_url": "http://example.com/a.jpg",
+             "owner_id": random.randint(1, 50)}
+            for i in range(1, posts + 1)
+        ])
+        conn.execute(models.Comment.__table__.insert(), [
+            {"text": "comment", "date": now + datetime.timedelta(seconds=i),
+             "owner_id": random.randint(1, 50), "post_id": random.randint(1, posts)}
+            for i in range(comments)
+        ])
+
+
+def report(engine, posts, repeat):
+    with engine.connect() as conn:
+        for name, (sql, params) in QUERIES.items():
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params(posts)).all()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params(posts)).all()
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            print(f"  {name}: {elapsed:.3f} ms")
+            for row in plan:
+                print(f"      {row[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=5000)
+    parser.add_argument("--comments", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        models.Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            for table in models.Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(conn)
+        fill(engine, args.posts, args.comments)
+
+        print("before migration:")
+        report(engine, args.posts, args.repeat)
+        migrate.upgrade(engine)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+        print("after migration:")
+        report(engine, args.posts, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""FTS5 search against a naive LIKE scan on a synthetic corpus.
+
+Generates posts (and a few comments per post) with random words into a
+throwaway SQLite file, builds the search index through `app.migrate` and
+times `search.search` against `body LIKE '%word%'` for a set of queries:
+
+    python -m benchmarks.search_corpus --posts 100000
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import database, migrate, models, search
+
+WORDS = [f"word{i}" for i in range(20000)]
+
+
+def sentence(words):
+    return " ".join(random.choices(WORDS, k=words))
+
+
+def fill(engine, posts, body_words, comments_per_post, batch=5000):
+    with engine.begin() as conn:
+        conn.execute(models.Users.__table__.insert(), [{"id": 1, "email": "bench@example.com", "name": "bench"}])
+    now = datetime.datetime(2023, 1, 1)
+    for start in range(0, posts, batch):
+        ids = range(start + 1, min(start + batch, posts) + 1)
+        with engine.begin() as conn:
+            conn.execute(models.BlogPost.__table__.insert(), [
+                {"id": i, "title": f"{sentence(4)} {i}", "subtitle": sentence(8), "date": "January 1, 2023",
+                 "body": f"<p>{sentence(body_words)}</p>", "author": "bench",
+                 "img_url": "http://example.com/a.jpg", "owner_id": 1}
+                for i in ids
+            ])
+            conn.execute(models.Comment.__table__.insert(), [
+                {"text": sentence(20), "date": now, "owner_id": 1, "post_id": i}
+                for i in ids for _ in range(comments_per_post)
+            ])
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--body-words", type=int, default=300)
+    parser.add_argument("--comments-per-post", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = database.build_engine(f"sqlite:///{os.path.join(tmp, 'search.db')}")
+        models.Base.metadata.create_all(bind=engine)
+
+        start = time.perf_counter()
+        fill(engine, args.posts, args.body_words, args.comments_per_post)
+        print(f"generated {args.posts} posts in {time.perf_counter() - start:.1f} s")
+
+        # the rows are already there, so this is the initial bulk build
+        start = time.perf_counter()
+        migrate.upgrade(engine)
+        print(f"built search index in {time.perf_counter() - start:.1f} s")
+
+        fts_total = like_total = 0
+        with Session(engine) as db:
+            for word in random.sample(WORDS, args.queries):
+                fts_ms, (results, _) = timed(lambda: search.search(db, word), args.repeat)
+                like_ms, _ = timed(lambda: db.execute(
+                    text("SELECT id FROM blog_post WHERE body LIKE :pattern LIMIT 11"),
+                    {"pattern": f"%{word} %"}).all(), args.repeat)
+                fts_total += fts_ms
+                like_total += like_ms
+        print(f"FTS5 search : {fts_total / args.queries:8.2f} ms per query (ranked, with snippets)")
+        print(f"LIKE scan   : {like_total / args.queries:8.2f} ms per query (unranked, posts only)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import re
+import tempfile
+import uuid
+
+import pytest
+
+# The app reads its settings on import, so the test database and friends
+# are chosen before anything from app/ is imported.
+_tmp = tempfile.mkdtemp(prefix="blog-tests-")
+os.environ.update({
+    "BLOG_DATABASE_URL": f"sqlite:///{os.path.join(_tmp, 'test.db')}",
+    "BLOG_AVATAR_CACHE_DIR": os.path.join(_tmp, "avatars"),
+    "BLOG_BCRYPT_ROUNDS": "4",
+    "BLOG_JOBS_SYNC": "true",
+    "BLOG_RATE_LIMIT_ENABLED": "false",
+    # enables the warm_feeds job, so writes do all the work they can
+    "BLOG_SITE_URL": "http://testserver",
+    "BLOG_BULK_API_TOKEN": "test-token",
+    "BLOG_LOG_LEVEL": "WARNING",
+})
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app import querybudget  # noqa: E402
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def csrf_token(client, url):
+    return CSRF.search(client.get(url).text).group(1)
+
+
+@pytest.fixture
+def enforce_query_budgets():
+    """Fail the test if any request in it goes over its route's budget."""
+    with querybudget.enforcing() as collected:
+        yield collected
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def user_client():
+    client = TestClient(app)
+    name = uuid.uuid4().hex[:10]
+    client.post("/register", data={"name": name, "email": f"{name}@example.com", "password": "pw"},
+                follow_redirects=False)
+    response = client.post("/login", data={"email": name, "password": "pw"}, follow_redirects=False)
+    assert response.status_code == 302, response.text
+    client.cookies.set("access_token", response.cookies["access_token"])
+    client.name = name
+    return client
+
+
+@pytest.fixture
+def post_id(user_client):
+    response = user_client.post("/new_post/", data={
+        "csrf_token": csrf_token(user_client, "/new_post/"), "title": f"Post {uuid.uuid4().hex}",
+        "subtitle": "subtitle", "author": "author", "img_url": "https://example.com/a.jpg",
+        "body": "<p>Hello <b>world</b></p>",
+    }, follow_redirects=False)
+    assert response.status_code == 302, response.text
+    return int(response.headers["location"].rsplit("/", 1)[1])
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from app import avatars
+
+DIGEST = avatars.email_hash("someone@example.com")
+
+
+def png_pixels(png):
+    assert png.startswith(b"\x89PNG\r\n\x1a\n")
+    width, height = struct.unpack(">II", png[16:24])
+    length = struct.unpack(">I", png[33:37])[0]
+    assert png[37:41] == b"IDAT"
+    return width, height, zlib.decompress(png[41:41 + length])
+
+
+def test_email_hash_ignores_case_and_whitespace():
+    assert avatars.email_hash(" Someone@Example.COM ") == DIGEST
+    assert avatars.avatar_url("someone@example.com", 48) == f"/avatar/{DIGEST}?s=48"
+
+
+def test_identicon_is_deterministic():
+    png = avatars.render(DIGEST, 100, "png")
+    assert avatars.render(DIGEST, 100, "png") == png
+    # served with an immutable Cache-Control, so the bytes must never change
+    assert hashlib.sha256(png).hexdigest() == "6fc3fba7c97e2778838bbee40e505ff7c55498e37dae0bf45a4926f41a661be1"
+    assert avatars.render(avatars.email_hash("other@example.com"), 100, "png") != png
+
+
+def test_identicon_is_a_valid_mirrored_png():
+    width, height, data = png_pixels(avatars.render(DIGEST, 60, "png"))
+    assert (width, height) == (60, 60)
+    rows = [data[y * (1 + 60 * 3):(y + 1) * (1 + 60 * 3)] for y in range(60)]
+    assert len(data) == 60 * (1 + 60 * 3)
+    for row in rows:
+        assert row[0] == 0  # no filter
+        pixels = [row[1 + x * 3:4 + x * 3] for x in range(60)]
+        assert pixels == pixels[::-1]
+
+
+def test_size_is_clamped(tmp_path, monkeypatch):
+    monkeypatch.setattr(avatars, "disk_cache", avatars.DiskCache(str(tmp_path), 10 ** 6))
+    data, image_format = avatars.get_avatar(DIGEST, 5000)
+    assert image_format == "png"
+    assert png_pixels(data)[:2] == (avatars.MAX_SIZE, avatars.MAX_SIZE)
+    assert png_pixels(avatars.get_avatar(DIGEST, 1)[0])[:2] == (avatars.MIN_SIZE, avatars.MIN_SIZE)
+    assert sorted(os.listdir(tmp_path)) == sorted([f"{DIGEST}-{avatars.MAX_SIZE}.png", f"{DIGEST}-{avatars.MIN_SIZE}.png"])
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = avatars.DiskCache(str(tmp_path), max_bytes=1000)
+    for index, name in enumerate("abc"):
+        cache.set(name, b"x" * 300)
+        os.utime(tmp_path / name, (index, index))
+    # reading "a" makes it the most recently used
+    assert cache.get("a") == b"x" * 300
+
+    cache.set("d", b"x" * 300)
+    assert sorted(os.listdir(tmp_path)) == ["a", "c", "d"]
+    assert cache.size == 900
+    assert cache.get("b") is None
+
+
+def test_disk_cache_counts_files_already_there(tmp_path):
+    (tmp_path / "old").write_bytes(b"x" * 800)
+    os.utime(tmp_path / "old", (0, 0))
+    cache = avatars.DiskCache(str(tmp_path), max_bytes=1000)
+    cache.set("new", b"x" * 300)
+    assert os.listdir(tmp_path) == ["new"]
+    assert cache.size == 300
+
+
+def test_avatar_route_validates_with_etag(client):
+    response = client.get(f"/avatar/{DIGEST}", params={"s": 40}, headers={"Accept": "image/png"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert "immutable" in response.headers["cache-control"]
+    assert response.content == avatars.render(DIGEST, 40, "png")
+    etag = response.headers["etag"]
+
+    response = client.get(f"/avatar/{DIGEST}", params={"s": 40}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # another size is another image
+    response = client.get(f"/avatar/{DIGEST}", params={"s": 41}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_avatar_route_rejects_other_names(client):
+    assert client.get("/avatar/not-a-hash").status_code == 404
+    assert client.get(f"/avatar/{DIGEST.upper()}").status_code == 404
@@ -0,0 +1,115 @@
+import datetime
+import json
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app import bulk, migrate, models
+from app.database import build_engine
+
+DATE = datetime.datetime(2024, 5, 1, 12, 0)
+
+
+def database(path):
+    engine = build_engine(f"sqlite:///{path}")
+    migrate.upgrade(engine)
+    return Session(engine)
+
+
+def add(db, *rows):
+    db.add_all(rows)
+    db.commit()
+    return rows
+
+
+def post(title, owner_id):
+    return models.BlogPost(title=title, subtitle="subtitle", date="May 1, 2024", body="<p>body</p>",
+                           author="author", img_url="https://example.com/a.jpg", owner_id=owner_id)
+
+
+@pytest.fixture
+def source(tmp_path):
+    with database(tmp_path / "source.db") as db:
+        alice, bob = add(db, models.Users(name="alice", email="alice@example.com"),
+                         models.Users(name="bob", email="bob@example.com"))
+        first, second = add(db, post("First", alice.id), post("Second", bob.id))
+        add(db,
+            models.Comment(text="nice", date=DATE, owner_id=bob.id, post_id=first.id),
+            # same author and date, told apart by the text
+            models.Comment(text="one", date=DATE, owner_id=alice.id, post_id=second.id),
+            models.Comment(text="two", date=DATE, owner_id=alice.id, post_id=second.id))
+        yield db
+
+
+@pytest.fixture
+def target(tmp_path):
+    # already has content, so none of the source's ids are free or the same
+    with database(tmp_path / "target.db") as db:
+        zed, bob = add(db, models.Users(name="zed", email="zed@example.com"),
+                       models.Users(name="robert", email="bob@example.com"))
+        add(db, post("Other", zed.id), post("Second", zed.id))
+        yield db
+
+
+def ids(db, model, column):
+    return dict(db.execute(select(column, model.id)).all())
+
+
+def comments(db):
+    users, posts = models.Users, models.BlogPost
+    return sorted(db.execute(
+        select(posts.title, users.name, models.Comment.text)
+        .join(posts, posts.id == models.Comment.post_id)
+        .join(users, users.id == models.Comment.owner_id)).all())
+
+
+def counts(db):
+    return [db.scalar(select(func.count()).select_from(model)) for model in (models.Users, models.BlogPost, models.Comment)]
+
+
+def test_round_trip_into_a_database_with_content(source, target):
+    lines = list(bulk.export_lines(source))
+    assert [json.loads(line)["type"] for line in lines] == ["user"] * 2 + ["post"] * 2 + ["comment"] * 3
+    assert "password" not in "".join(lines)
+
+    report = bulk.import_lines(target, lines, batch=2)
+    assert report["imported"] == {"user": 1, "post": 1, "comment": 3}
+    assert report["skipped"] == {"user": 1, "post": 1, "comment": 0}
+
+    users = ids(target, models.Users, models.Users.name)
+    posts = ids(target, models.BlogPost, models.BlogPost.title)
+    assert set(users) == {"zed", "robert", "alice"}
+    assert users["alice"] != ids(source, models.Users, models.Users.name)["alice"]
+    first = target.get(models.BlogPost, posts["First"])
+    assert first.owner_id == users["alice"]
+    assert first.body_html == "<p>body</p>" and first.body_text == "body"
+    # bob is robert here (same email), Second was already there
+    assert comments(target) == [("First", "robert", "nice"), ("Second", "alice", "one"), ("Second", "alice", "two")]
+    assert target.get(models.BlogPost, posts["Second"]).comment_count == 2
+
+    again = bulk.import_lines(target, lines)
+    assert again["imported"] == {"user": 0, "post": 0, "comment": 0}
+    assert again["skipped"] == {"user": 2, "post": 2, "comment": 3}
+    assert counts(target) == [3, 3, 3]
+
+
+def test_resume_after_a_failed_batch(source, target):
+    lines = list(bulk.export_lines(source))
+    broken = lines[:-1] + ['{"type": "comment", "id": 99}\n'] + lines[-1:]
+    # the last batch, [comment "two", broken], is rolled back as a whole
+    with pytest.raises(bulk.BulkImportError):
+        bulk.import_lines(target, broken, batch=2)
+    assert comments(target) == [("First", "robert", "nice"), ("Second", "alice", "one")]
+
+    report = bulk.import_lines(target, lines, batch=2)
+    assert report["imported"] == {"user": 0, "post": 0, "comment": 1}
+    assert comments(target) == [("First", "robert", "nice"), ("Second", "alice", "one"), ("Second", "alice", "two")]
+    assert counts(target) == [3, 3, 3]
+
+
+def test_bad_lines_are_reported():
+    with pytest.raises(bulk.BulkImportError, match="line 2"):
+        list(bulk.read_batches(['{"type": "user"}', "not json"]))
+    with pytest.raises(bulk.BulkImportError, match="unknown record type"):
+        bulk.Importer().feed(None, [{"type": "job"}])
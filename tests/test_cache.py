@@ -0,0 +1,62 @@
+import fakeredis
+
+from app import crud
+from app.cache import RedisCache, TTLCache, invalidate_index_pages, page_cache, page_group
+
+
+def redis_cache():
+    return RedisCache(fakeredis.FakeRedis(server=fakeredis.FakeServer()), "page", group=page_group)
+
+
+def test_group_invalidation_is_a_miss():
+    cache = redis_cache()
+    cache.set("post:1:page", "one")
+    cache.set("post:2:page", "two")
+    cache.delete_prefix("post:1:")
+    assert cache.get("post:1:page") is None
+    assert cache.get("post:2:page") == "two"
+
+
+def test_value_read_before_an_invalidation_is_not_kept():
+    cache = redis_cache()
+    value, generation = cache.lookup("index:")
+    assert value is None
+    # a write lands while the page is being rendered
+    cache.delete_prefix("index:")
+    cache.set("index:", "stale", generation=generation)
+    assert cache.get("index:") is None
+
+    value, generation = cache.lookup("index:")
+    cache.set("index:", "fresh", generation=generation)
+    assert cache.lookup("index:") == ("fresh", generation)
+
+
+def test_ttl_cache_drops_values_read_before_an_invalidation():
+    cache = TTLCache(group=page_group)
+    value, generation = cache.lookup("post:1:page")
+    cache.delete_prefix("post:1:")
+    cache.set("post:1:page", "stale", generation=generation)
+    assert cache.get("post:1:page") is None
+    # other groups are unaffected
+    value, generation = cache.lookup("post:2:page")
+    cache.delete_prefix("post:1:")
+    cache.set("post:2:page", "two", generation=generation)
+    assert cache.get("post:2:page") == "two"
+
+
+def test_index_rendered_during_a_write_is_not_cached(client, monkeypatch):
+    get_posts_page = crud.get_posts_page
+
+    def read_then_write(*args, **kwargs):
+        result = get_posts_page(*args, **kwargs)
+        # a post committed while the page is being rendered
+        invalidate_index_pages()
+        return result
+
+    page_cache.clear()
+    monkeypatch.setattr(crud, "get_posts_page", read_then_write)
+    assert client.get("/").status_code == 200
+    assert page_cache.get("index:") is None
+    monkeypatch.setattr(crud, "get_posts_page", get_posts_page)
+    assert client.get("/").status_code == 200
+    assert page_cache.get("index:") is not None
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+from app import crud, schemas
+from app.database import SessionLocal
+
+DATE = datetime.datetime(2024, 5, 1, 12, 0)
+
+
+@pytest.fixture
+def thread(user_client, post_id):
+    # seven comments, five of them in the same second: the id decides their order
+    with SessionLocal() as db:
+        owner_id = crud.get_user_by_name(db, user_client.name).id
+        dates = [DATE - datetime.timedelta(minutes=1)] + [DATE] * 5 + [DATE + datetime.timedelta(minutes=1)]
+        ids = [crud.add_comment(db, schemas.EntireComment(text=f"comment {i}", date=date, owner_id=owner_id,
+                                                          post_id=post_id))
+               for i, date in enumerate(dates)]
+    return post_id, ids
+
+
+def pages(client, post_id, limit):
+    texts, after, count = [], None, 0
+    while True:
+        params = {"format": "json", "limit": limit}
+        if after is not None:
+            params["after"] = after
+        response = client.get(f"/post/{post_id}/comments", params=params)
+        assert response.status_code == 200
+        body = response.json()
+        texts += [comment["text"] for comment in body["comments"]]
+        count += 1
+        after = body["next"]
+        if after is None:
+            return texts, count
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 20])
+def test_pages_cover_every_comment_once_in_order(client, thread, limit):
+    post_id, ids = thread
+    texts, count = pages(client, post_id, limit)
+    assert texts == [f"comment {i}" for i in range(7)]
+    # no empty page at the end: the last page is the one without a cursor
+    assert count == -(-7 // limit)
+
+
+def test_cursor_breaks_ties_by_id(thread):
+    post_id, ids = thread
+    with SessionLocal() as db:
+        first, after = crud.get_comments_page(db, post_id, limit=3)
+        assert [comment.id for comment in first] == ids[:3]
+        assert after == f"{DATE.isoformat()}_{ids[2]}"
+        rest, after = crud.get_comments_page(db, post_id, after=after, limit=3)
+        assert [comment.id for comment in rest] == ids[3:6]
+        last, after = crud.get_comments_page(db, post_id, after=after, limit=3)
+        assert [comment.id for comment in last] == ids[6:]
+        assert after is None
+
+
+def test_exactly_one_full_page_has_no_next(thread):
+    post_id, ids = thread
+    with SessionLocal() as db:
+        comments, after = crud.get_comments_page(db, post_id, limit=7)
+    assert len(comments) == 7 and after is None
+
+
+@pytest.mark.parametrize("cursor", ["", "garbage", "2024-05-01T12:00:00", "2024-05-01T12:00:00_x", "yesterday_1"])
+def test_malformed_cursor_is_a_400(client, thread, cursor):
+    post_id, ids = thread
+    response = client.get(f"/post/{post_id}/comments", params={"after": cursor})
+    assert response.status_code == 400
+
+
+def test_html_fragment(client, thread):
+    post_id, ids = thread
+    response = client.get(f"/post/{post_id}/comments", params={"limit": 3})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/html")
+    assert "<html" not in response.text
+    assert [f"comment {i}" in response.text for i in range(4)] == [True, True, True, False]
+    assert f'data-url="/post/{post_id}/comments?after=' in response.text
+
+    response = client.get(f"/post/{post_id}/comments", params={"limit": 7})
+    assert "comment 6" in response.text
+    assert "Load more comments" not in response.text
+
+
+def test_json_fields(client, thread):
+    post_id, ids = thread
+    body = client.get(f"/post/{post_id}/comments", params={"format": "json", "limit": 1}).json()
+    comment = body["comments"][0]
+    assert comment["id"] == ids[0] and comment["post_id"] == post_id
+    assert set(comment) >= {"id", "text", "date", "owner_id", "post_id", "avatar_url"}
+    assert body["next"] is not None
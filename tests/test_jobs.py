@@ -0,0 +1,117 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import jobs, models, pagecache
+from app.config import settings
+from app.database import SessionLocal
+from app.main import app
+
+BULK_HEADERS = {"X-Bulk-Token": "test-token"}
+
+calls = []
+
+
+@jobs.task("test_flaky", max_attempts=3)
+def flaky(db, value):
+    calls.append(value)
+    raise RuntimeError("flaky failed")
+
+
+@jobs.task("test_record", unique=True)
+def record(db, value):
+    calls.append(value)
+
+
+@pytest.fixture(autouse=True)
+def clean_queue():
+    calls.clear()
+    jobs.drain()
+    yield
+    jobs.drain()
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    # jobs stay in the table until drained
+    monkeypatch.setattr(settings, "jobs_sync", False)
+
+
+def enqueue(name, **payload):
+    with SessionLocal() as db:
+        job = jobs.enqueue(db, name, **payload)
+        db.commit()
+        return job.id
+
+
+def job_status(job_id):
+    with SessionLocal() as db:
+        return db.get(models.Job, job_id).status
+
+
+def test_sync_mode_runs_jobs_on_commit(user_client, post_id):
+    user_client.post(f"/post/{post_id}", data={"text": "hello"})
+    found = user_client.get("/jobs", headers=BULK_HEADERS, params={"status": "pending"}).json()
+    assert found["jobs"] == []
+    counts = user_client.get("/jobs", headers=BULK_HEADERS).json()["counts"]
+    assert counts["notify_post_owner"]["done"] >= 1
+    assert counts["warm_feeds"]["done"] >= 1
+
+
+def test_drain_runs_queued_jobs(queued):
+    job_id = enqueue("test_record", value=1)
+    assert job_status(job_id) == "pending"
+    assert jobs.drain() == 1
+    assert calls == [1]
+    assert job_status(job_id) == "done"
+
+
+def test_failing_job_is_retried_then_failed(queued):
+    job_id = enqueue("test_flaky", value="x")
+    jobs.drain()
+    assert calls == ["x"] * 3
+    with SessionLocal() as db:
+        job = db.get(models.Job, job_id)
+        assert job.status == "failed"
+        assert job.attempts == 3
+        assert "flaky failed" in job.last_error
+
+
+def test_rolled_back_job_is_never_run(queued):
+    with SessionLocal() as db:
+        jobs.enqueue(db, "test_record", value=1)
+        db.rollback()
+    assert jobs.drain() == 0
+
+
+def test_unique_jobs_are_merged_when_claimed(queued):
+    first, second = enqueue("test_record", value=1), enqueue("test_record", value=1)
+    other = enqueue("test_record", value=2)
+    assert jobs.drain() == 2
+    assert sorted(calls) == [1, 2]
+    assert {job_status(first), job_status(second), job_status(other)} == {"done"}
+
+
+def test_feeds_are_warm_after_a_write(user_client, post_id):
+    page = pagecache.get_page("feed:atom:http://testserver/")
+    assert page is not None
+    assert f"post/{post_id}" in page.body.decode()
+
+
+def test_workers_run_jobs(queued, user_client, post_id):
+    with TestClient(app) as client:
+        assert jobs.worker is not None
+        client.cookies = user_client.cookies
+        client.post(f"/post/{post_id}", data={"text": "for the worker"})
+        for _ in range(100):
+            pending = client.get("/jobs", headers=BULK_HEADERS, params={"status": "pending"}).json()["jobs"]
+            if not pending:
+                break
+            time.sleep(0.05)
+        assert pending == []
+    assert jobs.worker is None
+
+
+def test_jobs_endpoint_needs_the_token(client):
+    assert client.get("/jobs").status_code == 403
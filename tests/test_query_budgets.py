@@ -0,0 +1,93 @@
+"""Every route with a @querybudget.budget(n) stays within it.
+
+Runs under the enforce_query_budgets fixture, so a request over its budget
+fails the test with the call sites of the extra statements. The user cache
+and page cache are emptied before each request, so every request pays for
+what the first one after a deploy does.
+"""
+import pytest
+
+from app.cache import page_cache, user_cache
+from app.main import app
+
+from conftest import csrf_token
+
+BULK_HEADERS = {"X-Bulk-Token": "test-token"}
+
+
+@pytest.fixture(autouse=True)
+def budgets(enforce_query_budgets):
+    yield
+
+
+def cold(request, *args, **kwargs):
+    user_cache.clear()
+    page_cache.clear()
+    return request(*args, **kwargs)
+
+
+def post_form(client, url, **fields):
+    form = {"csrf_token": csrf_token(client, url), "title": f"Budget {fields.pop('title')}",
+            "subtitle": "subtitle", "author": "author", "img_url": "https://example.com/a.jpg",
+            "body": "<p>body</p>"}
+    form.update(fields)
+    return cold(client.post, url, data=form, follow_redirects=False)
+
+
+def test_public_pages(client, post_id):
+    for url in ["/", "/?sort=active", "/search?q=hello", f"/post/{post_id}",
+                f"/post/{post_id}/comments", "/feed.xml", "/sitemap.xml"]:
+        assert cold(client.get, url).status_code == 200, url
+
+
+def test_logged_in_pages(user_client, post_id):
+    for url in ["/", "/search?q=hello", f"/post/{post_id}", f"/edit/{post_id}"]:
+        assert cold(user_client.get, url).status_code == 200, url
+
+
+def test_avatar(client):
+    assert cold(client.get, "/avatar/" + "0" * 32).status_code == 200
+
+
+def test_register_login_and_token(client):
+    response = cold(client.post, "/register", data={"name": "budget", "email": "budget@example.com",
+                                                    "password": "pw"}, follow_redirects=False)
+    assert response.status_code == 302
+    assert cold(client.post, "/login", data={"email": "budget", "password": "pw"},
+                follow_redirects=False).status_code == 302
+    assert cold(client.post, "/token", data={"username": "budget", "password": "pw"}).status_code == 200
+
+
+def test_comment(user_client, post_id):
+    response = cold(user_client.post, f"/post/{post_id}", data={"text": "within budget"}, follow_redirects=False)
+    assert response.status_code == 303
+
+
+def test_new_edit_and_delete_post(user_client, post_id):
+    assert post_form(user_client, "/new_post/", title="new").status_code == 302
+    assert post_form(user_client, f"/edit/{post_id}", title="edited").status_code == 302
+    assert cold(user_client.get, f"/delete/{post_id}", follow_redirects=False).status_code == 302
+
+
+def test_jobs(client):
+    assert cold(client.get, "/jobs", headers=BULK_HEADERS).status_code == 200
+
+
+def test_bulk_routes_are_unbudgeted():
+    # their work grows with the data; anything else should declare a budget
+    unbudgeted = {route.path for route in app.routes
+                  if getattr(getattr(route, "endpoint", None), "query_budget", 0) is None}
+    assert unbudgeted == {"/export.ndjson", "/import"}
+
+
+def test_every_budgeted_route_is_covered():
+    covered = {
+        ("GET", "/"), ("GET", "/search"), ("GET", "/post/{index}"), ("GET", "/post/{index}/comments"),
+        ("GET", "/feed.xml"), ("GET", "/sitemap.xml"), ("GET", "/edit/{id}"), ("GET", "/avatar/{email_hash}"),
+        ("POST", "/register"), ("POST", "/login"), ("POST", "/token"), ("POST", "/post/{index}"),
+        ("POST", "/new_post/"), ("POST", "/edit/{id}"), ("GET", "/delete/{id}"), ("GET", "/jobs"),
+    }
+    budgeted = {(method, route.path) for route in app.routes
+                if isinstance(getattr(getattr(route, "endpoint", None), "query_budget", None), int)
+                for method in route.methods}
+    assert budgeted <= covered, budgeted - covered
@@ -0,0 +1,44 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import ratelimit
+from app.config import settings
+from app.main import app
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_enabled", True)
+    ratelimit.configure({"login.ip": "1000/minute", "login.user": "2/minute"})
+    ratelimit.store.clear()
+    yield TestClient(app)
+    ratelimit.configure(settings.rate_limits)
+    ratelimit.store.clear()
+
+
+def test_account_limit_applies_to_urlencoded_and_multipart(limited):
+    email = f"{uuid.uuid4().hex[:10]}@example.com"
+    for _ in range(2):
+        response = limited.post("/login", data={"email": email, "password": "wrong"}, follow_redirects=False)
+        assert response.status_code != 429
+    # the same account, sent as multipart instead
+    response = limited.post("/login", data={"email": email.upper(), "password": "wrong"},
+                            files={"unused": ("a.txt", b"x")}, follow_redirects=False)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    # another account is still let through
+    response = limited.post("/login", data={"email": "someone@example.com", "password": "wrong"},
+                            files={"unused": ("a.txt", b"x")}, follow_redirects=False)
+    assert response.status_code != 429
+
+
+def test_oversized_form_is_refused(limited):
+    padding = "x" * (ratelimit.MAX_FORM_BYTES + 1)
+    response = limited.post("/login", data={"password": padding, "email": "a@example.com"},
+                            follow_redirects=False)
+    assert response.status_code == 413
+    response = limited.post("/login", data={"email": "a@example.com", "password": "wrong"},
+                            files={"unused": ("a.txt", padding.encode())}, follow_redirects=False)
+    assert response.status_code == 413
@@ -0,0 +1,98 @@
+import pytest
+
+from app.rendering import EXCERPT_WORDS, READING_SPEED, render_post
+
+
+def sanitize(body):
+    return render_post(body).body_html
+
+
+@pytest.mark.parametrize("href", [
+    "javascript:alert(1)",
+    "JaVaScRiPt:alert(1)",
+    " javascript:alert(1)",
+    "java\tscript:alert(1)",
+    "java&#x09;script:alert(1)",
+    "java&#10;script:alert(1)",
+    "javascript&#58;alert(1)",
+    "&#106;avascript:alert(1)",
+    "&#14;javascript:alert(1)",
+    "vbscript:msgbox(1)",
+    "data:text/html,<script>alert(1)</script>",
+])
+def test_unsafe_urls_are_dropped(href):
+    assert sanitize(f'<a href="{href}">x</a>') == "<a>x</a>"
+    assert sanitize(f'<img src="{href}">') == "<img>"
+
+
+def test_safe_urls_are_kept():
+    assert sanitize('<a href="https://example.com/a">x</a>') == (
+        '<a href="https://example.com/a" rel="nofollow noopener">x</a>')
+    assert sanitize('<a href="/post/1">x</a>') == '<a href="/post/1" rel="nofollow noopener">x</a>'
+    assert sanitize('<a href="mailto:me@example.com">x</a>') == (
+        '<a href="mailto:me@example.com" rel="nofollow noopener">x</a>')
+
+
+@pytest.mark.parametrize("body, expected", [
+    ("<p>a<script>alert(1)</script>b</p>", "<p>ab</p>"),
+    ("<p>a<style>p { color: red }</style>b</p>", "<p>ab</p>"),
+    ("<SCRIPT>alert(1)</SCRIPT>ok", "ok"),
+    # the first </script> ends it, as in a browser
+    ("<script>'<p>'</p><b></script>ok", "ok"),
+    ("<iframe src='https://example.com'><p>inside</p></iframe>ok", "ok"),
+    ("<script>never closed <p>text</p>", ""),
+    ("<!-- <script>alert(1)</script> -->ok", "ok"),
+])
+def test_dropped_tags_take_their_content_with_them(body, expected):
+    assert sanitize(body) == expected
+    assert "alert" not in render_post(body).body_text
+
+
+@pytest.mark.parametrize("body, expected", [
+    ("<p>one<b>two", "<p>one<b>two</b></p>"),
+    ("<b><i>x</b>y</i>", "<b><i>x</i></b>y"),
+    ("</p>stray</b><i>x</p>", "stray<i>x</i>"),
+    ("<ul><li>a<li>b</ul>", "<ul><li>a<li>b</li></li></ul>"),
+    ("<div/><br/><img/>", "<div></div><br><img>"),
+    ("<p><unknown>kept text</unknown></p>", "<p>kept text</p>"),
+])
+def test_output_is_balanced(body, expected):
+    assert sanitize(body) == expected
+
+
+def test_attributes_are_filtered_quoted_and_escaped():
+    assert sanitize('<p onclick="alert(1)" class="x" style="color: red">a</p>') == "<p>a</p>"
+    assert sanitize('<img src=x.png onerror=alert(1) alt=\'a "quoted" <alt>\'>') == (
+        '<img src="x.png" alt="a &quot;quoted&quot; &lt;alt&gt;">')
+    assert sanitize("<a title='\"><script>alert(1)</script>' href=\"https://e.com/?a=1&b=2\">x</a>") == (
+        '<a title="&quot;&gt;&lt;script&gt;alert(1)&lt;/script&gt;" href="https://e.com/?a=1&amp;b=2"'
+        ' rel="nofollow noopener">x</a>')
+    # valueless attributes are dropped rather than rendered as empty
+    assert sanitize("<a href>x</a>") == "<a>x</a>"
+
+
+def test_text_is_escaped():
+    assert sanitize("<p>a &lt;b&gt; &amp; <i>c</i></p>") == "<p>a &lt;b&gt; &amp; <i>c</i></p>"
+    assert sanitize("1 < 2 > 0") == "1 &lt; 2 &gt; 0"
+
+
+def test_body_text_separates_blocks_and_unescapes():
+    rendered = render_post("<h1>Title</h1><p>one <b>two</b></p><p>a &amp; b</p><ul><li>x</li><li>y</li></ul>")
+    assert rendered.body_text == "Title one two a & b x y"
+    assert "<" not in render_post('<p><a href="https://e.com">link</a></p>').body_text
+
+
+def test_excerpt_and_reading_time():
+    short = render_post("<p>just a few words</p>")
+    assert short.excerpt == "just a few words"
+    assert short.reading_time == 1
+
+    words = [f"w{i}" for i in range(READING_SPEED * 3)]
+    long = render_post("<p>" + " ".join(words) + "</p>")
+    assert long.excerpt == " ".join(words[:EXCERPT_WORDS]) + "…"
+    assert long.body_text == " ".join(words)
+    assert long.reading_time == 3
+
+
+def test_empty_body():
+    assert render_post("") == render_post(None) == ("", "", "", 1)
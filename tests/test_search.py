@@ -0,0 +1,162 @@
+import datetime
+import uuid
+
+import pytest
+from sqlalchemy import delete, text, update
+
+from app import crud, models, schemas, search
+from app.database import SessionLocal
+
+
+def word():
+    # one token to the unicode61 tokenizer, and in nothing else
+    return "zq" + uuid.uuid4().hex
+
+
+@pytest.fixture
+def db():
+    with SessionLocal() as db:
+        yield db
+
+
+@pytest.fixture
+def owner_id(db):
+    name = uuid.uuid4().hex[:10]
+    crud.register_user(db, schemas.User(name=name, email=f"{name}@example.com", password="x"))
+    return crud.get_user_by_name(db, name).id
+
+
+def new_post(db, owner_id, body, title=None):
+    return crud.create_post(db, schemas.EntirePost(
+        title=title or f"Post {uuid.uuid4().hex}", subtitle="subtitle", author="author",
+        img_url="https://example.com/a.jpg", body=body, owner_id=owner_id))
+
+
+def new_comment(db, owner_id, post_id, comment):
+    return crud.add_comment(db, schemas.EntireComment(
+        text=comment, date=datetime.datetime.utcnow(), owner_id=owner_id, post_id=post_id))
+
+
+def found(db, query):
+    results, has_next = search.search(db, query, limit=100)
+    return [(result.post_id, result.is_comment) for result in results]
+
+
+def index_rows(db, post_id):
+    return db.execute(text("SELECT rowid FROM search_index WHERE post_id = :id ORDER BY rowid"),
+                      {"id": post_id}).scalars().all()
+
+
+def test_posts_stay_in_sync(db, owner_id):
+    first, second = word(), word()
+    post_id = new_post(db, owner_id, f"<p>{first} <b>bold</b></p>")
+    assert found(db, first) == [(post_id, False)]
+    assert index_rows(db, post_id) == [post_id * 2]
+
+    crud.update_post(db, schemas.EntirePost(
+        title=f"Edited {second}", subtitle="subtitle", author="author", img_url="https://example.com/a.jpg",
+        body="<p>replaced</p>", owner_id=owner_id), post_id)
+    assert found(db, first) == []
+    assert found(db, second) == [(post_id, False)]
+    assert index_rows(db, post_id) == [post_id * 2]
+
+    crud.delete_post(db, post_id)
+    assert found(db, second) == []
+    assert index_rows(db, post_id) == []
+
+
+def test_body_markup_is_not_indexed(db, owner_id):
+    term = word()
+    post_id = new_post(db, owner_id, f'<p><a href="https://{term}.example.com">link</a></p>')
+    assert found(db, term) == []
+    assert (post_id, False) in found(db, "link")
+
+
+def test_comments_stay_in_sync(db, owner_id):
+    first, second = word(), word()
+    post_id = new_post(db, owner_id, "<p>post</p>")
+    comment_id = new_comment(db, owner_id, post_id, f"a comment with {first}")
+    assert found(db, first) == [(post_id, True)]
+    assert index_rows(db, post_id) == sorted([post_id * 2, comment_id * 2 + 1])
+
+    db.execute(update(models.Comment).where(models.Comment.id == comment_id).values(text=f"now {second}"))
+    db.commit()
+    assert found(db, first) == []
+    assert found(db, second) == [(post_id, True)]
+
+    db.execute(delete(models.Comment).where(models.Comment.id == comment_id))
+    db.commit()
+    assert found(db, second) == []
+    assert index_rows(db, post_id) == [post_id * 2]
+
+
+def test_deleting_a_post_drops_its_comments(db, owner_id):
+    term = word()
+    post_id = new_post(db, owner_id, "<p>post</p>")
+    new_comment(db, owner_id, post_id, term)
+    crud.delete_post(db, post_id)
+    assert found(db, term) == []
+    assert index_rows(db, post_id) == []
+
+
+@pytest.mark.parametrize("query", [
+    '"', "'", '"unbalanced', "a AND", "OR", "NOT x", "x NEAR(y)", "title:x", "-x", "^x", "x*", "(x", "x)",
+    "{title body}: x", "a + b", "🙂", "",
+])
+def test_query_syntax_in_user_input(db, query):
+    results, has_next = search.search(db, query)
+    assert isinstance(results, list)
+
+
+def test_operators_are_searched_as_words(db, owner_id):
+    term = word()
+    post_id = new_post(db, owner_id, f"<p>{term} cats and dogs</p>")
+    assert found(db, f'"{term}" OR') == []  # "or" is a word this post doesn't have
+    assert found(db, f"{term} AND dogs") == [(post_id, False)]
+    assert found(db, f"title:{term}") == []  # no column filters either
+    assert found(db, f"{term} -dogs") == [(post_id, False)]
+
+
+def test_fts_query():
+    assert search.fts_query('say "hi" OR NEAR(x)') == '"say" "hi" "OR" "NEAR" "x"*'
+    assert search.fts_query('" * -') is None
+
+
+def test_last_word_is_a_prefix(db, owner_id):
+    term = word()
+    post_id = new_post(db, owner_id, f"<p>{term}suffix</p>")
+    assert found(db, term) == [(post_id, False)]
+
+
+def test_snippet_is_escaped_and_highlighted(db, owner_id):
+    term = word()
+    post_id = new_post(db, owner_id, f"<p>{term} &lt;script&gt;</p>")
+    results, has_next = search.search(db, term)
+    assert results[0].post_id == post_id
+    assert f"<mark>{term}</mark>" in results[0].snippet
+    assert "<script>" not in results[0].snippet
+
+
+def test_pages(db, owner_id):
+    term = word()
+    post_ids = {new_post(db, owner_id, f"<p>{term} {i}</p>") for i in range(7)}
+
+    seen = []
+    for page in (1, 2, 3):
+        results, has_next = search.search(db, term, page=page, limit=3)
+        seen += [result.post_id for result in results]
+        assert has_next == (page < 3)
+    assert len(seen) == 7 and set(seen) == post_ids
+
+    assert search.search(db, term, page=4, limit=3) == ([], False)
+    # page numbers below 1 are the first page
+    assert search.search(db, term, page=0, limit=3)[0] == search.search(db, term, page=1, limit=3)[0]
+
+
+def test_search_route(client, db, owner_id):
+    term = word()
+    new_post(db, owner_id, f"<p>{term}</p>")
+    response = client.get("/search", params={"q": term})
+    assert response.status_code == 200
+    assert f"<mark>{term}</mark>" in response.text
+    assert client.get("/search", params={"q": '"NEAR( OR'}).status_code == 200